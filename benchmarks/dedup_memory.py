@@ -0,0 +1,88 @@
+"""Redis memory used per million processed events by each dedup layout
+
+Requires a disposable Redis instance, it is flushed between runs:
+
+    python benchmarks/dedup_memory.py --host localhost --port 6379 --events 1000000
+
+All events land on the same bucket, so with the default 1024 shards sets
+holding more than `set-max-intset-entries` members lose the intset encoding,
+raise --shards to at least events / set-max-intset-entries to compare the
+layout sized for that load.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dedup import BucketedDedupStore, KeyDedupStore  # noqa: E402
+
+
+def used_memory(client: redis.Redis) -> int:
+    return client.info("memory")["used_memory"]
+
+
+def run(client: redis.Redis, store, events: int) -> int:
+    client.flushall()
+    before = used_memory(client)
+
+    for event_id in random.Random(0).sample(range(10**15, 10**16), events):
+        store.mark_as_processed(str(event_id))
+
+    return used_memory(client) - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--expiration", type=int, default=36000)
+    parser.add_argument("--bucket-size", type=int, default=3600)
+    parser.add_argument("--shards", type=int, default=1024)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=args.host, port=args.port, password=args.password)
+    stores = {
+        "keys": KeyDedupStore(redis_client=client, expiration=args.expiration),
+        "buckets": BucketedDedupStore(
+            redis_client=client,
+            expiration=args.expiration,
+            bucket_size=args.bucket_size,
+            shards=args.shards,
+        ),
+    }
+
+    intset_entries = int(
+        client.config_get("set-max-intset-entries")["set-max-intset-entries"]
+    )
+    members_per_set = args.events / args.shards
+    print(
+        f"{members_per_set:.0f} events per set with {args.shards} shards, "
+        f"set-max-intset-entries is {intset_entries}"
+        + (
+            f", use --shards {-(-args.events // intset_entries)} or more to keep intsets"
+            if members_per_set > intset_entries
+            else ""
+        )
+    )
+
+    for name, store in stores.items():
+        used = run(client=client, store=store, events=args.events)
+        per_million = used * 1_000_000 / args.events
+        print(
+            f"{name:>8}: {used / 2**20:10.1f} MiB total, "
+            f"{per_million / 2**20:10.1f} MiB per million events, "
+            f"{used / args.events:6.1f} bytes per event"
+        )
+
+    client.flushall()
+
+
+if __name__ == "__main__":
+    main()
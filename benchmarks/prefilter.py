@@ -0,0 +1,60 @@
+"""Cost of pre filter rejections compared to a full signature verification
+
+python benchmarks/prefilter.py --number 2000
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from ellipticcurve import Ecdsa, PrivateKey, Signature
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from prefilter import WebhookPreFilter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    private_key = PrivateKey()
+    public_key = private_key.publicKey()
+    event_body = json.dumps({"event": {"id": "6046987522670592", "log": {}}})
+    digital_signature = Ecdsa.sign(event_body, private_key).toBase64()
+    oversized_event_body = "{" + "a" * 1_000_000 + "}"
+    webhook_prefilter = WebhookPreFilter()
+
+    def verify(body, signature):
+        try:
+            Ecdsa.verify(body, Signature.fromBase64(signature), public_key)
+        except Exception:
+            pass
+
+    cases = {
+        "full verification": lambda: verify(event_body, digital_signature),
+        "full verification, junk signature": lambda: verify(event_body, "AAAA" * 24),
+        "pre filter, valid request": lambda: webhook_prefilter.filter(
+            event_body, digital_signature
+        ),
+        "pre filter, oversized body": lambda: webhook_prefilter.filter(
+            oversized_event_body, digital_signature
+        ),
+        "pre filter, non JSON body": lambda: webhook_prefilter.filter(
+            "<xml></xml>", digital_signature
+        ),
+        "pre filter, malformed signature": lambda: webhook_prefilter.filter(
+            event_body, "not a signature!"
+        ),
+    }
+
+    for name, case in cases.items():
+        seconds = timeit.timeit(case, number=args.number) / args.number
+        print(f"{name:>35}: {seconds * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Routing decisions per second by number of routing rules
+
+python benchmarks/routing.py --rules 10000 --decisions 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from clients.starkbank import InvoiceLog, TransferDestination  # noqa: E402
+from routing import RoutingRule, TransferRouter  # noqa: E402
+
+
+def destination(index: int) -> dict:
+    return {
+        "name": f"Destination {index}",
+        "cpf_cnpj": f"{index:011d}",
+        "bank_code": "20018183",
+        "branch_code": "0001",
+        "account_number": f"{index:016d}",
+        "weight": 1 + index % 3,
+    }
+
+
+def build_rules(count: int, rng: random.Random) -> list:
+    rules = []
+    for index in range(count):
+        kind = index % 3
+        if kind == 0:
+            rule = {"tags": [f"tag-{index}"], "min_amount": rng.randrange(0, 1000)}
+        elif kind == 1:
+            rule = {"tax_id": f"{index:014d}"}
+        else:
+            min_amount = rng.randrange(0, 10**7)
+            rule = {"min_amount": min_amount, "max_amount": min_amount + 10**4}
+        rules.append(
+            {**rule, "destinations": [destination(index), destination(-index)]}
+        )
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=10000)
+    parser.add_argument("--decisions", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    started_at = time.perf_counter()
+    router = TransferRouter(
+        rules=[RoutingRule.from_dict(rule) for rule in build_rules(args.rules, rng)],
+        default_destination=TransferDestination(
+            name="Default",
+            cpf_cnpj="20.018.183/0001-80",
+            bank_code="20018183",
+            branch_code="0001",
+            account_number="6341320293482496",
+            account_type="payment",
+        ),
+    )
+    compile_seconds = time.perf_counter() - started_at
+
+    invoice_logs = [
+        (
+            InvoiceLog(
+                log_type="credited",
+                invoice_fee=100,
+                invoice_id=str(index),
+                paid_amount=amount + 100,
+                invoice_tags=[f"tag-{rng.randrange(args.rules)}", "other"],
+                invoice_tax_id=f"{rng.randrange(args.rules):014d}",
+            ),
+            amount,
+        )
+        for index, amount in enumerate(
+            rng.randrange(1, 10**7) for _ in range(args.decisions)
+        )
+    ]
+
+    started_at = time.perf_counter()
+    for invoice_log, amount in invoice_logs:
+        router.route(invoice_log=invoice_log, amount=amount)
+    seconds = time.perf_counter() - started_at
+
+    print(f"compiled {args.rules} rules in {compile_seconds * 1e3:.1f} ms")
+    print(
+        f"{args.decisions / seconds:,.0f} decisions/s "
+        f"({seconds / args.decisions * 1e6:.2f} us each)"
+    )
+
+
+if __name__ == "__main__":
+    main()
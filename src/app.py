@@ -1,14 +1,46 @@
 import json
 import logging
+import time
 
-from config import StagingConfig
+from config import Config, ProjectConfig, StagingConfig, as_bool, get_projects
+from prefilter import WebhookPreFilter, rejections
 from use_case import InvoiceWebhookUseCase
 
-
 logger = logging.getLogger()
+default_config = StagingConfig()
+
+
+def is_warm_up_event(event: dict) -> bool:
+    return bool(event.get("warmup")) or (
+        event.get("source") == "aws.events"
+        and event.get("detail-type") == "Scheduled Event"
+    )
+
 
+def warm_up(config: Config) -> dict:
+    """Builds the clients of every project and opens their connections,
+    returning the seconds each step took by project"""
+    configs = [
+        ProjectConfig(config=config, project=project)
+        for project in get_projects(config)
+    ]
+    if config["STARKBANK_PROJECT_ID"]:
+        configs.insert(0, config)
 
-def lambda_handler(event, context, config=StagingConfig()):
+    timings = {}
+    for project_config in configs:
+        started_at = time.perf_counter()
+        use_case = InvoiceWebhookUseCase(config=project_config, logger=logger)
+        project_timings = {"adapter": time.perf_counter() - started_at}
+        project_timings.update(use_case.warm_up())
+        # Scheduled warm ups also write the audit records left pending
+        use_case.flush_audit()
+        timings[project_config.project or "default"] = project_timings
+
+    return timings
+
+
+def lambda_handler(event, context, config=default_config):
     logger.setLevel(config["LOGLEVEL"] or "INFO")
 
     """Sample pure Lambda function
@@ -31,13 +63,53 @@ def lambda_handler(event, context, config=StagingConfig()):
 
         Return doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
     """
+    if is_warm_up_event(event):
+        timings = warm_up(config=config)
+        logger.info(f"Warmed up in {timings}")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "Warmed up", "timings": timings}),
+        }
+
+    headers = event.get("headers") or {}
+    event_body, rejection = WebhookPreFilter.from_config(config).filter(
+        event_body=event.get("body"),
+        digital_signature=headers.get("Digital-Signature"),
+        is_base64_encoded=bool(event.get("isBase64Encoded")),
+    )
+    if rejection:
+        logger.info(
+            f"Received a request rejected before verification by {rejection.reason}, "
+            f"rejections so far {dict(rejections)}"
+        )
+        return {
+            "statusCode": rejection.status_code,
+            "body": json.dumps({"message": rejection.response_message}),
+        }
+
+    if project := (
+        (event.get("pathParameters") or {}).get("project")
+        or headers.get("Starkbank-Project")
+    ):
+        if project not in get_projects(config):
+            logger.info(f"Received a request for unknown project {project}")
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"message": "Unknown project"}),
+            }
+
+        config = ProjectConfig(config=config, project=project)
+
     use_case = InvoiceWebhookUseCase(config=config, logger=logger)
-    status_code, response_message, log_message = (
-        use_case.process_invoice_credited_webhook(
-            event_body=event.get("body"),
-            event_headers=event.get("headers", {}),
+    try:
+        status_code, response_message, log_message = (
+            use_case.process_invoice_credited_webhook(
+                event_body=event_body,
+                event_headers=headers,
+            )
         )
-    )
+    finally:
+        use_case.flush_audit()
 
     logger.info(log_message)
     return {
@@ -48,3 +120,11 @@ def lambda_handler(event, context, config=StagingConfig()):
             }
         ),
     }
+
+
+if as_bool(default_config["EAGER_INIT"]):
+    try:
+        logger.setLevel(default_config["LOGLEVEL"] or "INFO")
+        logger.info(f"Eagerly initialized in {warm_up(config=default_config)}")
+    except Exception:
+        logger.exception("Eager initialization failed, will initialize on demand")
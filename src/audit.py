@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Optional
+
+import redis
+
+from cache import process_lru_cache
+from config import Config, ProjectConfig, StagingConfig
+
+
+class AuditRecord(NamedTuple):
+    recorded_at: str
+    outcome: str
+    status_code: int
+    project: Optional[str] = None
+    event_id: Optional[str] = None
+    invoice_id: Optional[str] = None
+    paid_amount: Optional[int] = None
+    invoice_fee: Optional[int] = None
+    transfer_ids: Optional[List[str]] = None
+    timings: Optional[Dict[str, float]] = None
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def from_json(cls, value) -> "AuditRecord":
+        return cls(**json.loads(value))
+
+
+def now_isoformat() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Naive datetimes are taken as UTC, as records are recorded in it"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - started_at
+
+
+class AuditSink(ABC):
+    @abstractmethod
+    def write(self, records: List[AuditRecord]) -> None:
+        """Durably writes the batch of records, raising on failure"""
+        pass
+
+    @abstractmethod
+    def read(self, after: Optional[datetime] = None) -> Iterator[AuditRecord]:
+        """Streams the records recorded from `after` on, oldest first"""
+        pass
+
+
+class RedisStreamAuditSink(AuditSink):
+    """Records appended to a Redis stream with one pipelined XADD per batch"""
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        stream: str = "starkbank-audit",
+        maxlen: Optional[int] = None,
+        read_batch_size: int = 1000,
+    ) -> None:
+        self._redis_client = redis_client
+        self._stream = stream
+        self._maxlen = maxlen
+        self._read_batch_size = read_batch_size
+
+    def write(self, records: List[AuditRecord]) -> None:
+        with self._redis_client.pipeline(transaction=False) as pipe:
+            for record in records:
+                pipe.xadd(
+                    self._stream,
+                    {"record": record.to_json()},
+                    maxlen=self._maxlen,
+                    approximate=True,
+                )
+            pipe.execute()
+
+    def read(self, after: Optional[datetime] = None) -> Iterator[AuditRecord]:
+        after = _as_utc(after)
+        # Entries are written after being recorded, so their ids are never
+        # older than their recorded_at
+        min_id = f"{int(after.timestamp() * 1000)}-0" if after else "-"
+        while entries := self._redis_client.xrange(
+            self._stream, min=min_id, count=self._read_batch_size
+        ):
+            for _, fields in entries:
+                record = AuditRecord.from_json(fields[b"record"])
+                if after is None or datetime.fromisoformat(record.recorded_at) >= after:
+                    yield record
+            min_id = f"({entries[-1][0].decode()}"
+
+
+class JsonlAuditSink(AuditSink):
+    """Records appended as JSON lines to a local file, one write per batch"""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def write(self, records: List[AuditRecord]) -> None:
+        with open(self._path, "a") as file:
+            file.write("".join(f"{record.to_json()}\n" for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def read(self, after: Optional[datetime] = None) -> Iterator[AuditRecord]:
+        if not os.path.exists(self._path):
+            return
+
+        after = _as_utc(after)
+
+        with open(self._path) as file:
+            for line in file:
+                record = AuditRecord.from_json(line)
+                if after is None or datetime.fromisoformat(record.recorded_at) >= after:
+                    yield record
+
+
+class AuditBuffer:
+    """Write-behind buffer of audit records for a sink
+
+    Records are written in a single batch once `batch_size` of them are
+    pending, once the oldest is `flush_interval` seconds old when another one
+    is recorded, or when flushed explicitly. Batches the sink fails
+    to write are kept for the next flush, up to `max_pending` records, the
+    oldest being dropped past it and counted on `dropped`.
+    """
+
+    def __init__(
+        self,
+        sink: AuditSink,
+        batch_size: int = 100,
+        flush_interval: float = 5.0,
+        max_pending: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._sink = sink
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._clock = clock
+        self._pending: Deque[AuditRecord] = deque(maxlen=max_pending)
+        self._oldest_pending_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def record(self, record: AuditRecord) -> None:
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(record)
+            if self._oldest_pending_at is None:
+                self._oldest_pending_at = self._clock()
+            should_flush = len(self._pending) >= self._batch_size or (
+                self._clock() - self._oldest_pending_at >= self._flush_interval
+            )
+
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes the pending records, returning how many were written"""
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+            self._oldest_pending_at = None
+
+        if not batch:
+            return 0
+
+        try:
+            self._sink.write(batch)
+        except (redis.RedisError, OSError):
+            with self._lock:
+                room = self._pending.maxlen - len(self._pending)
+                requeued = batch[max(len(batch) - room, 0) :]
+                self.dropped += len(batch) - len(requeued)
+                self._pending.extendleft(reversed(requeued))
+                self._oldest_pending_at = self._clock()
+            return 0
+
+        return len(batch)
+
+
+def audit_sink_from_config(
+    redis_client: Optional[redis.Redis], config: Config
+) -> Optional[AuditSink]:
+    sink = config["AUDIT_SINK"]
+
+    if not sink:
+        return None
+
+    if sink == "redis":
+        return RedisStreamAuditSink(
+            redis_client=redis_client,
+            stream=config["AUDIT_STREAM"] or "starkbank-audit",
+            maxlen=(
+                int(config["AUDIT_STREAM_MAXLEN"])
+                if config["AUDIT_STREAM_MAXLEN"]
+                else None
+            ),
+        )
+
+    if sink == "jsonl":
+        if not config["AUDIT_FILE"]:
+            raise ValueError("AUDIT_SINK jsonl requires AUDIT_FILE")
+        return JsonlAuditSink(path=config["AUDIT_FILE"])
+
+    raise ValueError(f"Unknown AUDIT_SINK {sink}")
+
+
+def audit_buffer_from_config(
+    redis_client: redis.Redis, config: Config
+) -> Optional[AuditBuffer]:
+    """Buffer kept by the process for the configured sink, so records a sink
+    failed to write are retried by the next invocations"""
+    if (sink := audit_sink_from_config(redis_client, config)) is None:
+        return None
+
+    buffers = process_lru_cache("audit-buffers", maxsize=8)
+    buffer_key = (
+        config["AUDIT_SINK"],
+        config["AUDIT_STREAM"],
+        config["AUDIT_FILE"],
+        redis_client,
+    )
+    if (buffer := buffers.get(buffer_key)) is None:
+        buffer = AuditBuffer(
+            sink=sink,
+            batch_size=int(config["AUDIT_BATCH_SIZE"] or 100),
+            flush_interval=float(config["AUDIT_FLUSH_INTERVAL"] or 5),
+            max_pending=int(config["AUDIT_MAX_PENDING"] or 10000),
+        )
+        buffers.set(buffer_key, buffer)
+    return buffer
+
+
+def main(argv: Optional[List[str]] = None, config: Config = StagingConfig()) -> None:
+    parser = argparse.ArgumentParser(
+        description="Export the audit records of processed events as JSON lines"
+    )
+    parser.add_argument(
+        "--after",
+        type=datetime.fromisoformat,
+        help="Export only records from this ISO datetime on, UTC when without offset, e.g. 2024-01-31T00:00:00+00:00",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="File where records are written as JSON lines, stdout by default",
+    )
+    parser.add_argument("--project", help="One of STARKBANK_PROJECTS")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr)
+    logger = logging.getLogger()
+    logger.setLevel(config["LOGLEVEL"] or "INFO")
+
+    if args.project:
+        config = ProjectConfig(config=config, project=args.project)
+
+    sink = audit_sink_from_config(
+        redis_client=redis.Redis(
+            host=config["REDIS_HOST"],
+            port=config["REDIS_PORT"],
+            password=config["REDIS_PASSWORD"],
+        ),
+        config=config,
+    )
+    if sink is None:
+        parser.error("AUDIT_SINK is not configured")
+
+    exported = 0
+    for record in sink.read(after=args.after):
+        args.output.write(f"{record.to_json()}\n")
+        exported += 1
+
+    logger.info(f"Exported {exported} audit records")
+
+
+if __name__ == "__main__":
+    main()
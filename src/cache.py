@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import redis
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread safe in-process LRU cache with optional per entry TTL"""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self._clock():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = self._clock() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_process_caches: Dict[str, LRUCache] = {}
+
+
+def process_lru_cache(name: str, maxsize: int, ttl: Optional[float] = None) -> LRUCache:
+    """LRU cache shared by every invocation served by the running process"""
+    if (cache := _process_caches.get(name)) is None:
+        cache = _process_caches.setdefault(name, LRUCache(maxsize=maxsize, ttl=ttl))
+    return cache
+
+
+class ReadThroughCache:
+    """In-process LRU backed by an optional Redis tier, filled by a loader"""
+
+    def __init__(
+        self,
+        local: LRUCache,
+        redis_client: Optional[redis.Redis] = None,
+        key_prefix: str = "",
+        ttl: Optional[int] = None,
+        dumps: Callable[[Any], str] = json.dumps,
+        loads: Callable[[bytes], Any] = json.loads,
+    ) -> None:
+        self._local = local
+        self._redis_client = redis_client
+        self._key_prefix = key_prefix
+        self._ttl = ttl
+        self._dumps = dumps
+        self._loads = loads
+
+    def _get_shared(self, key: str) -> Any:
+        try:
+            value = self._redis_client.get(f"{self._key_prefix}{key}")
+        except redis.RedisError:
+            return _MISSING
+        if value is None:
+            return _MISSING
+
+        # Values that can not be decoded, e.g. written by other versions, miss
+        try:
+            return self._loads(value)
+        except ValueError:
+            return _MISSING
+
+    def _set_shared(self, key: str, value: Any) -> None:
+        try:
+            self._redis_client.set(
+                f"{self._key_prefix}{key}", self._dumps(value), ex=self._ttl
+            )
+        except redis.RedisError:
+            pass
+
+    def get(self, key: str) -> Any:
+        value = self._local.get(key, _MISSING)
+        if value is _MISSING and self._redis_client is not None:
+            value = self._get_shared(key)
+            if value is not _MISSING:
+                self._local.set(key, value)
+
+        return None if value is _MISSING else value
+
+    def set(self, key: str, value: Any) -> None:
+        self._local.set(key, value)
+        if self._redis_client is not None:
+            self._set_shared(key, value)
+
+    def get_or_load(self, key: str, loader: Callable[[], Any]) -> Any:
+        if (value := self.get(key)) is not None:
+            return value
+
+        value = loader()
+        self.set(key, value)
+        return value
@@ -1,65 +1,265 @@
-from typing import NamedTuple, Optional, Tuple
+import hashlib
+import json
+from datetime import date
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 
 import starkbank
+from starkbank.utils.relay import set_relay
+from starkcore.utils.api import from_api_json
+from starkcore.utils.parse import verify
 
+from cache import ReadThroughCache
 from config import Config
 
+_verify_signature = set_relay(verify)
+
+# Well formed signature that no content matches, the public key is only
+# fetched to verify well formed ones
+_PUBLIC_KEY_PRIMING_SIGNATURE = "MAYCAQECAQE="
+
+_INVOICE_TRANSFER_TAG_PREFIX = "invoice-"
+
+
+def get_invoice_transfer_tag(invoice_id: str) -> str:
+    return f"{_INVOICE_TRANSFER_TAG_PREFIX}{invoice_id}"
+
+
+def get_invoice_transfer_external_id(
+    invoice_id: str, route_index: int, attempt: int = 0
+) -> str:
+    external_id = f"{_INVOICE_TRANSFER_TAG_PREFIX}{invoice_id}-{route_index}"
+    return f"{external_id}-{attempt}" if attempt else external_id
+
+
+def get_invoice_id_from_transfer_tags(tags: Optional[List[str]]) -> Optional[str]:
+    for tag in tags or []:
+        if tag.startswith(_INVOICE_TRANSFER_TAG_PREFIX):
+            return tag[len(_INVOICE_TRANSFER_TAG_PREFIX) :]
+    return None
+
 
 class InvoiceLog(NamedTuple):
     log_type: str
     invoice_fee: int
     invoice_id: str
     paid_amount: Optional[int] = None
+    invoice_tags: Optional[List[str]] = None
+    invoice_tax_id: Optional[str] = None
+
+
+class TransferDestination(NamedTuple):
+    name: str
+    cpf_cnpj: str
+    bank_code: str
+    branch_code: str
+    account_number: str
+    account_type: str
+
+
+class TransferRoute(NamedTuple):
+    destination: TransferDestination
+    amount: int
+
+
+class WebhookEvent(NamedTuple):
+    id: str
+    subscription: str
+    log_type: Optional[str]
+    invoice_id: Optional[str]
+    invoice_fee: Optional[int]
+    invoice_tags: Optional[List[str]]
+    invoice_tax_id: Optional[str]
+    content: str
+
+    @classmethod
+    def from_content(cls, content: str) -> "WebhookEvent":
+        event = json.loads(content, strict=False)["event"]
+        log = event.get("log") or {}
+        invoice = (
+            log.get("invoice") if event["subscription"] == "invoice" else None
+        ) or {}
+
+        return cls(
+            id=event["id"],
+            subscription=event["subscription"],
+            log_type=log.get("type"),
+            invoice_id=invoice.get("id"),
+            invoice_fee=invoice.get("fee"),
+            invoice_tags=invoice.get("tags"),
+            invoice_tax_id=invoice.get("taxId"),
+            content=content,
+        )
+
+    def to_entity(self) -> starkbank.Event:
+        return from_api_json(
+            resource={"class": starkbank.Event, "name": "Event"},
+            json=json.loads(self.content, strict=False)["event"],
+        )
 
 
 class InvalidDigitalSignature(Exception):
     pass
 
 
+class DuplicatedTransfer(Exception):
+    def __init__(self, transfer_ids: List[str]) -> None:
+        super().__init__(f"Transfers already created with ids {transfer_ids}")
+        self.transfer_ids = transfer_ids
+
+
 class StarkBankAdapter:
-    def __init__(self, config: Config):
-        user = starkbank.Project(
+    def __init__(
+        self,
+        config: Config,
+        payment_amount_cache: Optional[ReadThroughCache] = None,
+        verified_event_cache: Optional[ReadThroughCache] = None,
+    ):
+        self._user = starkbank.Project(
             environment=config["STARKBANK_ENVIRONMENT"],
             id=config["STARKBANK_PROJECT_ID"],
             private_key=config["STARKBANK_PRIVATE_KEY_CONTENT"],
         )
-        starkbank.user = user
 
         self._starkbank_client = starkbank
+        self._payment_amount_cache = payment_amount_cache
+        self._verified_event_cache = verified_event_cache
+
+    def fetch_public_key(self) -> None:
+        """Caches the Stark Bank public key used to verify webhooks, by
+        verifying a signature that never matches it"""
+        try:
+            _verify_signature(
+                content="", signature=_PUBLIC_KEY_PRIMING_SIGNATURE, user=self._user
+            )
+        except self._starkbank_client.error.InvalidSignatureError:
+            pass
 
     def get_event_entity_and_id_from_body(
         self, event_body: str, digital_signature: str
     ) -> Tuple[starkbank.Event, str]:
         try:
             event = self._starkbank_client.event.parse(
-                content=event_body, signature=digital_signature
+                content=event_body, signature=digital_signature, user=self._user
             )
         except self._starkbank_client.error.InvalidSignatureError:
             raise InvalidDigitalSignature
 
         return event, event.id
 
+    def get_webhook_event_from_body(
+        self, event_body: str, digital_signature: str
+    ) -> WebhookEvent:
+        if not self._verified_event_cache:
+            return self._verify_webhook_event(
+                event_body=event_body, digital_signature=digital_signature
+            )
+
+        # Only the exact body and signature pair that was verified before hits
+        # the cache, the body itself is not stored as it is the cache key
+        digest = hashlib.sha256(
+            f"{digital_signature}\0{event_body}".encode()
+        ).hexdigest()
+        event_fields = self._verified_event_cache.get(digest)
+        # Entries written by other versions may lack fields or use another
+        # format, only the id and subscription are required to rebuild it
+        if isinstance(event_fields, dict) and {"id", "subscription"} <= set(
+            event_fields
+        ):
+            return WebhookEvent(
+                **{
+                    field: event_fields.get(field)
+                    for field in WebhookEvent._fields
+                    if field != "content"
+                },
+                content=event_body,
+            )
+
+        webhook_event = self._verify_webhook_event(
+            event_body=event_body, digital_signature=digital_signature
+        )
+        self._verified_event_cache.set(
+            digest,
+            {
+                field: value
+                for field, value in webhook_event._asdict().items()
+                if field != "content"
+            },
+        )
+        return webhook_event
+
+    def _verify_webhook_event(
+        self, event_body: str, digital_signature: str
+    ) -> WebhookEvent:
+        try:
+            content = _verify_signature(
+                content=event_body, signature=digital_signature, user=self._user
+            )
+        except self._starkbank_client.error.InvalidSignatureError:
+            raise InvalidDigitalSignature
+
+        return WebhookEvent.from_content(content)
+
     def get_invoice_data_from_event_entity(
         self, event_entity: starkbank.Event
     ) -> Optional[InvoiceLog]:
         if event_entity.subscription != "invoice":
             return None
 
-        invoice = event_entity.log.invoice
-        if (log_type := event_entity.log.type) != "credited":
-            return InvoiceLog(
-                log_type=log_type, invoice_fee=invoice.fee, invoice_id=invoice.id
-            )
+        return self.get_invoice_log(
+            log_type=event_entity.log.type,
+            invoice_fee=event_entity.log.invoice.fee,
+            invoice_id=event_entity.log.invoice.id,
+            invoice_tags=event_entity.log.invoice.tags,
+            invoice_tax_id=event_entity.log.invoice.tax_id,
+        )
+
+    def get_invoice_data_from_webhook_event(
+        self, webhook_event: WebhookEvent
+    ) -> Optional[InvoiceLog]:
+        if webhook_event.subscription != "invoice":
+            return None
 
-        payment = self._starkbank_client.invoice.payment(invoice.id)
+        return self.get_invoice_log(
+            log_type=webhook_event.log_type,
+            invoice_fee=webhook_event.invoice_fee,
+            invoice_id=webhook_event.invoice_id,
+            invoice_tags=webhook_event.invoice_tags,
+            invoice_tax_id=webhook_event.invoice_tax_id,
+        )
 
-        return InvoiceLog(
+    def get_invoice_log(
+        self,
+        log_type: str,
+        invoice_fee: int,
+        invoice_id: str,
+        invoice_tags: Optional[List[str]] = None,
+        invoice_tax_id: Optional[str] = None,
+    ) -> InvoiceLog:
+        invoice_log = InvoiceLog(
             log_type=log_type,
-            invoice_fee=invoice.fee,
-            invoice_id=invoice.id,
-            paid_amount=payment.amount,
+            invoice_fee=invoice_fee,
+            invoice_id=invoice_id,
+            invoice_tags=invoice_tags,
+            invoice_tax_id=invoice_tax_id,
+        )
+        if log_type != "credited":
+            return invoice_log
+
+        return invoice_log._replace(
+            paid_amount=self._get_invoice_paid_amount(invoice_id=invoice_id)
         )
 
+    def _get_invoice_paid_amount(self, invoice_id: str) -> int:
+        def get_payment_amount() -> int:
+            return self._starkbank_client.invoice.payment(
+                invoice_id, user=self._user
+            ).amount
+
+        if not self._payment_amount_cache:
+            return get_payment_amount()
+
+        return self._payment_amount_cache.get_or_load(invoice_id, get_payment_amount)
+
     def create_transfer(
         self,
         amount: int,
@@ -70,19 +270,94 @@ class StarkBankAdapter:
         account_number: str,
         account_type: str,
         tag: Optional[str] = None,
+        invoice_id: Optional[str] = None,
     ) -> str:
-        transfers = self._starkbank_client.transfer.create(
-            [
-                self._starkbank_client.Transfer(
-                    amount=amount,
-                    tax_id=cpf_cnpj,
-                    name=name,
-                    bank_code=bank_code,
-                    branch_code=branch_code,
-                    account_number=account_number,
-                    account_type=account_type,
-                    tags=[tag] if tag else None,
-                )
-            ]
+        destination = TransferDestination(
+            name=name,
+            cpf_cnpj=cpf_cnpj,
+            bank_code=bank_code,
+            branch_code=branch_code,
+            account_number=account_number,
+            account_type=account_type,
+        )
+        return self.create_transfers(
+            routes=[TransferRoute(destination=destination, amount=amount)],
+            tag=tag,
+            invoice_id=invoice_id,
+        )[0]
+
+    def create_transfers(
+        self,
+        routes: List[TransferRoute],
+        tag: Optional[str] = None,
+        invoice_id: Optional[str] = None,
+        attempt: int = 0,
+    ) -> List[str]:
+        """Creates one transfer per route. Transfers of an invoice get external
+        ids from its id, route and attempt, so creating them again is rejected
+        by Stark Bank and raises DuplicatedTransfer"""
+        tags = [tag] if tag else []
+        if invoice_id:
+            tags.append(get_invoice_transfer_tag(invoice_id))
+
+        try:
+            transfers = self._starkbank_client.transfer.create(
+                [
+                    self._starkbank_client.Transfer(
+                        amount=route.amount,
+                        tax_id=route.destination.cpf_cnpj,
+                        name=route.destination.name,
+                        bank_code=route.destination.bank_code,
+                        branch_code=route.destination.branch_code,
+                        account_number=route.destination.account_number,
+                        account_type=route.destination.account_type,
+                        external_id=(
+                            get_invoice_transfer_external_id(
+                                invoice_id=invoice_id,
+                                route_index=route_index,
+                                attempt=attempt,
+                            )
+                            if invoice_id
+                            else None
+                        ),
+                        tags=tags or None,
+                    )
+                    for route_index, route in enumerate(routes)
+                ],
+                user=self._user,
+            )
+        except self._starkbank_client.error.InputErrors:
+            if invoice_id and (
+                transfer_ids := [
+                    transfer.id
+                    for transfer in self.get_invoice_transfers(invoice_id)
+                    if transfer.status != "failed"
+                ]
+            ):
+                raise DuplicatedTransfer(transfer_ids)
+            raise
+
+        return [transfer.id for transfer in transfers]
+
+    def get_credited_invoice_logs(
+        self, after: date, before: date
+    ) -> Iterator[starkbank.invoice.Log]:
+        return self._starkbank_client.invoice.log.query(
+            types=["credited"], after=after, before=before, user=self._user
+        )
+
+    def get_invoice_transfers(self, invoice_id: str) -> Iterator[starkbank.Transfer]:
+        return self._starkbank_client.transfer.query(
+            tags=[get_invoice_transfer_tag(invoice_id)], user=self._user
+        )
+
+    def get_transfers(
+        self, after: date, before: date, tag: Optional[str] = None
+    ) -> Iterator[starkbank.Transfer]:
+        return self._starkbank_client.transfer.query(
+            tags=[tag] if tag else None,
+            after=after,
+            before=before,
+            sort="-created",
+            user=self._user,
         )
-        return transfers[0].id
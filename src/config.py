@@ -1,11 +1,21 @@
+import json
 import os
+import re
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, List, Optional
 
 from dotenv import dotenv_values
 
 
+def as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
 class Config(ABC):
+    project: Optional[str] = None
+
     @abstractmethod
     def __getitem__(self, key: str) -> Any:
         pass
@@ -13,10 +23,16 @@ class Config(ABC):
 
 class StagingConfig(Config):
     def __init__(self, *args, **kwargs) -> None:
-        self._config_envs = {
+        config_envs = {
             **dotenv_values(".env"),
             **os.environ,
         }
+        # Projects configs resolved from a secret as a single JSON object,
+        # the ones set directly taking precedence
+        self._config_envs = {
+            **json.loads(config_envs.get("STARKBANK_PROJECTS_SECRETS") or "{}"),
+            **config_envs,
+        }
 
     def __getitem__(self, key: str) -> Any:
         return self._config_envs.get(key)
@@ -28,3 +44,49 @@ class TestingConfig(Config):
 
     def __getitem__(self, key: str) -> Any:
         return self._configs_dict.get(key)
+
+
+class ProjectConfig(Config):
+    """Config of one of STARKBANK_PROJECTS
+
+    Keys are looked up prefixed by the project name (e.g. ACME__TRANSFERS_TAG
+    for project acme), falling back to the unprefixed key shared by all
+    projects. Credentials and transfer destination never fall back, so a
+    project missing them can not use the ones of another project.
+    """
+
+    project_keys = frozenset(
+        {
+            "STARKBANK_PROJECT_ID",
+            "STARKBANK_PRIVATE_KEY_CONTENT",
+            "TRANSFER_DESTINATION_NAME",
+            "TRANSFER_DESTINATION_CPF_CNPJ",
+            "TRANSFER_DESTINATION_BANK_CODE",
+            "TRANSFER_DESTINATION_BRANCH",
+            "TRANSFER_DESTINATION_ACCOUNT",
+            "TRANSFER_DESTINATION_ACCOUNT_TYPE",
+        }
+    )
+
+    def __init__(self, config: Config, project: str, *args, **kwargs) -> None:
+        self._config = config
+        self._prefix = re.sub(r"[^A-Z0-9]", "_", project.upper()) + "__"
+        self.project = project
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._config[f"{self._prefix}{key}"]
+        if value is not None:
+            return value
+        if key in self.project_keys:
+            raise ValueError(
+                f"{self._prefix}{key} is required for project {self.project}"
+            )
+        return self._config[key]
+
+
+def get_projects(config: Config) -> List[str]:
+    return [
+        project.strip()
+        for project in (config["STARKBANK_PROJECTS"] or "").split(",")
+        if project.strip()
+    ]
@@ -0,0 +1,127 @@
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+import redis
+
+from config import Config, as_bool
+
+
+class DedupStore(ABC):
+    @abstractmethod
+    def mark_as_processed(self, event_id: str) -> bool:
+        """Atomically marks event_id as processed, returning False if it
+        already was"""
+        pass
+
+
+class KeyDedupStore(DedupStore):
+    """One `starkbank-event-id:<id>` key per event, each with its own TTL"""
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        expiration: int,
+        key_prefix: str = "starkbank-event-id:",
+    ) -> None:
+        self._redis_client = redis_client
+        self._expiration = expiration
+        self._key_prefix = key_prefix
+
+    def mark_as_processed(self, event_id: str) -> bool:
+        return bool(
+            self._redis_client.set(
+                f"{self._key_prefix}{event_id}",
+                1,
+                nx=True,
+                ex=self._expiration,
+            )
+        )
+
+
+class BucketedDedupStore(DedupStore):
+    """Event ids stored as members of time bucketed sets, sharded by id
+
+    Numeric ids are kept by Redis as integers, and while each shard stays under
+    `set-max-intset-entries` it uses the compact intset encoding, so the cost
+    per event is a few bytes instead of a whole key. Buckets expire as a whole
+    once every event in them is older than the expiration.
+
+    Size shards as at least the peak events per bucket divided by
+    `set-max-intset-entries` (512 by default): the default 1024 shards keep
+    the intset encoding up to about 500 thousand events per bucket.
+
+    With `legacy_key_prefix`, the per event keys written by `KeyDedupStore`
+    are also checked, so switching layouts does not process again the events
+    received before the switch.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        expiration: int,
+        bucket_size: int = 3600,
+        shards: int = 1024,
+        clock: Callable[[], float] = time.time,
+        legacy_key_prefix: Optional[str] = None,
+    ) -> None:
+        self._redis_client = redis_client
+        self._expiration = expiration
+        self._bucket_size = bucket_size
+        self._shards = shards
+        self._clock = clock
+        self._legacy_key_prefix = legacy_key_prefix
+
+    def _shard(self, event_id: str) -> int:
+        if event_id.isdigit():
+            return int(event_id) % self._shards
+        return zlib.crc32(event_id.encode()) % self._shards
+
+    @staticmethod
+    def _bucket_key(bucket: int, shard: int) -> str:
+        return f"starkbank-event-ids:{bucket}:{shard}"
+
+    def mark_as_processed(self, event_id: str) -> bool:
+        now = self._clock()
+        shard = self._shard(event_id)
+        current_bucket = int(now // self._bucket_size)
+        oldest_bucket = int((now - self._expiration) // self._bucket_size)
+        current_key = self._bucket_key(current_bucket, shard)
+
+        with self._redis_client.pipeline(transaction=True) as pipe:
+            if self._legacy_key_prefix is not None:
+                pipe.exists(f"{self._legacy_key_prefix}{event_id}")
+            for bucket in range(oldest_bucket, current_bucket):
+                pipe.sismember(self._bucket_key(bucket, shard), event_id)
+            pipe.sadd(current_key, event_id)
+            pipe.expireat(
+                current_key,
+                (current_bucket + 1) * self._bucket_size + self._expiration,
+            )
+            *seen_before, added, _ = pipe.execute()
+
+        return bool(added) and not any(seen_before)
+
+
+def dedup_store_from_config(redis_client: redis.Redis, config: Config) -> DedupStore:
+    expiration = int(config["DUPLICATED_EVENT_VALIDATION_EXP"] or 36000)
+    storage = config["DUPLICATED_EVENT_VALIDATION_STORAGE"] or "keys"
+
+    if storage == "keys":
+        return KeyDedupStore(redis_client=redis_client, expiration=expiration)
+
+    if storage == "buckets":
+        return BucketedDedupStore(
+            redis_client=redis_client,
+            expiration=expiration,
+            bucket_size=int(config["DUPLICATED_EVENT_VALIDATION_BUCKET_SIZE"] or 3600),
+            shards=int(config["DUPLICATED_EVENT_VALIDATION_BUCKET_SHARDS"] or 1024),
+            legacy_key_prefix=(
+                "starkbank-event-id:"
+                if as_bool(config["DUPLICATED_EVENT_VALIDATION_LEGACY_KEYS"] or "true")
+                else None
+            ),
+        )
+
+    raise ValueError(f"Unknown DUPLICATED_EVENT_VALIDATION_STORAGE {storage}")
@@ -0,0 +1,96 @@
+import base64
+import binascii
+import re
+from collections import Counter
+from typing import NamedTuple, Optional, Tuple
+
+from config import Config
+
+_BASE64_SIGNATURE = re.compile(r"[A-Za-z0-9+/]+={0,2}")
+
+rejections: "Counter[str]" = Counter()
+
+
+class Rejection(NamedTuple):
+    reason: str
+    status_code: int
+    response_message: str
+
+
+class WebhookPreFilter:
+    """Rejects webhooks that can not be valid before any signature verification
+
+    Checks only the body size, its JSON object delimiters and the signature
+    base64 format and length, counting rejections by reason on `rejections`.
+    """
+
+    def __init__(
+        self,
+        max_body_size: int = 65536,
+        min_signature_length: int = 16,
+        max_signature_length: int = 256,
+    ) -> None:
+        self._max_body_size = max_body_size
+        self._min_signature_length = min_signature_length
+        self._max_signature_length = max_signature_length
+
+    @classmethod
+    def from_config(cls, config: Config) -> "WebhookPreFilter":
+        return cls(
+            max_body_size=int(config["WEBHOOK_MAX_BODY_SIZE"] or 65536),
+            min_signature_length=int(config["WEBHOOK_MIN_SIGNATURE_LENGTH"] or 16),
+            max_signature_length=int(config["WEBHOOK_MAX_SIGNATURE_LENGTH"] or 256),
+        )
+
+    def filter(
+        self,
+        event_body: Optional[str],
+        digital_signature: Optional[str],
+        is_base64_encoded: bool = False,
+    ) -> Tuple[Optional[str], Optional[Rejection]]:
+        """Returns the body, decoded once if base64 encoded, or the rejection.
+        Missing body or signature are left to be answered by the use case"""
+        if event_body and is_base64_encoded:
+            # Decoded bodies are 3/4 of the encoded size
+            if len(event_body) * 3 // 4 > self._max_body_size:
+                return None, self._reject("body_too_large", 400)
+            try:
+                event_body = base64.b64decode(event_body, validate=True).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                return None, self._reject("body_not_base64", 400)
+
+        if event_body:
+            if len(event_body) > self._max_body_size:
+                return None, self._reject("body_too_large", 400)
+
+            if not (
+                event_body.lstrip().startswith("{")
+                and event_body.rstrip().endswith("}")
+            ):
+                return None, self._reject("body_not_json", 400)
+
+        if digital_signature:
+            if not (
+                self._min_signature_length
+                <= len(digital_signature)
+                <= self._max_signature_length
+            ):
+                return event_body, self._reject("signature_length", 401)
+
+            if len(digital_signature) % 4 or not _BASE64_SIGNATURE.fullmatch(
+                digital_signature
+            ):
+                return event_body, self._reject("signature_malformed", 401)
+
+        return event_body, None
+
+    @staticmethod
+    def _reject(reason: str, status_code: int) -> Rejection:
+        rejections[reason] += 1
+        return Rejection(
+            reason=reason,
+            status_code=status_code,
+            response_message=(
+                "Invalid Digital-Signature" if status_code == 401 else "Invalid body"
+            ),
+        )
@@ -0,0 +1,290 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import deque
+from datetime import date, datetime, time as datetime_time, timedelta, timezone
+from logging import Logger
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+import starkbank
+
+from clients.starkbank import get_invoice_id_from_transfer_tags
+from config import Config, ProjectConfig, StagingConfig
+from use_case import InvoiceWebhookUseCase
+
+
+class ReconciliationReport(NamedTuple):
+    credited_invoices: int
+    transfers: int
+    mismatches: int
+    reprocessed: int
+    elapsed: float
+
+    @property
+    def rate(self) -> float:
+        return (self.credited_invoices + self.transfers) / (self.elapsed or 1e-9)
+
+
+class InvoiceReconciliationUseCase:
+    """Checks that every credited invoice produced exactly one transfer
+
+    Credited invoice logs and transfers tagged with TRANSFERS_TAG are streamed
+    newest first and merge joined by the invoice id tag of the transfers. An
+    invoice split between destinations by TRANSFER_ROUTING_RULES has one
+    transfer per destination, so only repeated destinations are reported. Only
+    the transfers created in the last RECONCILIATION_TRANSFER_LAG seconds
+    before the current log are kept in memory, so the memory used does not
+    grow with the reconciled period.
+    """
+
+    def __init__(
+        self,
+        logger: Logger,
+        config: Config,
+        webhook_use_case: InvoiceWebhookUseCase,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self._logger = logger
+        self._config = config
+        self._webhook_use_case = webhook_use_case
+        self._clock = clock
+        self._sb_adapter = webhook_use_case.sb_adapter
+        self._transfer_lag = timedelta(
+            seconds=int(config["RECONCILIATION_TRANSFER_LAG"] or 3600)
+        )
+        self._progress_every = int(config["RECONCILIATION_PROGRESS_EVERY"] or 10000)
+
+    def reconcile(
+        self,
+        after: date,
+        before: date,
+        output: TextIO,
+        reprocess: bool = False,
+        reprocess_after: Optional[date] = None,
+    ) -> ReconciliationReport:
+        """Writes the mismatches found to output. With reprocess, creates the
+        transfers of invoices without one credited from reprocess_after on,
+        which must not be earlier than the first transfer tagged by invoice,
+        and over RECONCILIATION_TRANSFER_LAG seconds ago, as webhooks of more
+        recent ones may still be delivered"""
+        if reprocess and reprocess_after is None:
+            raise ValueError("Reprocessing requires reprocess_after")
+
+        started_at = time.monotonic()
+        counts = {"credited_invoices": 0, "transfers": 0, "mismatches": 0}
+        reprocessed = 0
+
+        # Stark Bank datetimes are parsed as naive UTC datetimes
+        window_start = datetime.combine(after, datetime_time())
+        window_end = datetime.combine(before + timedelta(days=1), datetime_time())
+        reprocess_start = (
+            datetime.combine(reprocess_after, datetime_time())
+            if reprocess_after
+            else None
+        )
+        reprocess_end = (
+            datetime.fromtimestamp(self._clock(), timezone.utc).replace(tzinfo=None)
+            - self._transfer_lag
+        )
+
+        def write_mismatch(mismatch: dict) -> None:
+            counts["mismatches"] += 1
+            output.write(json.dumps(mismatch, default=str) + "\n")
+
+        def transfers_without_credited_invoice(
+            transfers: List[starkbank.Transfer],
+        ) -> None:
+            for transfer in transfers:
+                if window_start + self._transfer_lag <= transfer.created < window_end:
+                    write_mismatch(
+                        {
+                            "type": "transfer_without_credited_invoice",
+                            "transfer_id": transfer.id,
+                            "invoice_id": get_invoice_id_from_transfer_tags(
+                                transfer.tags
+                            ),
+                            "created": transfer.created,
+                        }
+                    )
+
+        transfers = self._count(
+            self._sb_adapter.get_transfers(
+                after=after,
+                before=(window_end + self._transfer_lag).date(),
+                tag=self._config["TRANSFERS_TAG"],
+            ),
+            counts=counts,
+            key="transfers",
+            started_at=started_at,
+        )
+        pending_transfers: Dict[str, List[starkbank.Transfer]] = {}
+        pending_order: Deque[Tuple[datetime, str]] = deque()
+        next_transfer = next(transfers, None)
+
+        for log in self._count(
+            self._sb_adapter.get_credited_invoice_logs(after=after, before=before),
+            counts=counts,
+            key="credited_invoices",
+            started_at=started_at,
+        ):
+            while next_transfer is not None and next_transfer.created >= log.created:
+                if invoice_id := get_invoice_id_from_transfer_tags(next_transfer.tags):
+                    pending_transfers.setdefault(invoice_id, []).append(next_transfer)
+                    pending_order.append((next_transfer.created, invoice_id))
+                else:
+                    transfers_without_credited_invoice([next_transfer])
+                next_transfer = next(transfers, None)
+
+            while pending_order and (
+                pending_order[0][0] > log.created + self._transfer_lag
+            ):
+                _, invoice_id = pending_order.popleft()
+                transfers_without_credited_invoice(
+                    pending_transfers.pop(invoice_id, [])
+                )
+
+            invoice = log.invoice
+            invoice_transfers = pending_transfers.pop(invoice.id, [])
+            destinations = {
+                (
+                    transfer.tax_id,
+                    transfer.bank_code,
+                    transfer.branch_code,
+                    transfer.account_number,
+                )
+                for transfer in invoice_transfers
+            }
+            if len(destinations) < len(invoice_transfers):
+                write_mismatch(
+                    {
+                        "type": "multiple_transfers",
+                        "invoice_id": invoice.id,
+                        "transfer_ids": [transfer.id for transfer in invoice_transfers],
+                        "credited": log.created,
+                    }
+                )
+            elif not invoice_transfers:
+                transfer_ids = None
+                if reprocess and reprocess_start <= log.created < reprocess_end:
+                    transfer_ids = self._webhook_use_case.reprocess_credited_invoice(
+                        invoice_id=invoice.id,
+                        invoice_fee=invoice.fee,
+                        invoice_tags=invoice.tags,
+                        invoice_tax_id=invoice.tax_id,
+                    )
+                    if transfer_ids:
+                        reprocessed += 1
+                write_mismatch(
+                    {
+                        "type": "missing_transfer",
+                        "invoice_id": invoice.id,
+                        "log_id": log.id,
+                        "credited": log.created,
+                        "reprocessed_transfer_ids": transfer_ids,
+                    }
+                )
+
+        for _, invoice_id in pending_order:
+            transfers_without_credited_invoice(pending_transfers.pop(invoice_id, []))
+        while next_transfer is not None:
+            transfers_without_credited_invoice([next_transfer])
+            next_transfer = next(transfers, None)
+
+        return ReconciliationReport(
+            credited_invoices=counts["credited_invoices"],
+            transfers=counts["transfers"],
+            mismatches=counts["mismatches"],
+            reprocessed=reprocessed,
+            elapsed=time.monotonic() - started_at,
+        )
+
+    def _count(
+        self, items: Iterator, counts: Dict[str, int], key: str, started_at: float
+    ) -> Iterator:
+        for item in items:
+            counts[key] += 1
+            if counts[key] % self._progress_every == 0:
+                self._logger.info(
+                    f"Read {counts[key]} {key.replace('_', ' ')}, "
+                    f"{counts[key] / (time.monotonic() - started_at):.1f}/s"
+                )
+            yield item
+
+
+def main(argv: Optional[List[str]] = None, config: Config = StagingConfig()) -> None:
+    parser = argparse.ArgumentParser(
+        description="Reconcile credited invoices with created transfers"
+    )
+    parser.add_argument("--after", type=date.fromisoformat, required=True)
+    parser.add_argument("--before", type=date.fromisoformat, required=True)
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="File where mismatches are written as JSON lines, stdout by default",
+    )
+    parser.add_argument(
+        "--reprocess",
+        action="store_true",
+        help="Create transfers for credited invoices without one",
+    )
+    parser.add_argument(
+        "--reprocess-after",
+        type=date.fromisoformat,
+        help=(
+            "Only reprocess invoices credited from this date on, required with "
+            "--reprocess. Transfers created before invoice-<id> tags existed "
+            "are not found, so never set it earlier than that"
+        ),
+    )
+    parser.add_argument("--project", help="One of STARKBANK_PROJECTS")
+    args = parser.parse_args(argv)
+    if args.reprocess and args.reprocess_after is None:
+        parser.error("--reprocess requires --reprocess-after")
+
+    logging.basicConfig(stream=sys.stderr)
+    logger = logging.getLogger()
+    logger.setLevel(config["LOGLEVEL"] or "INFO")
+
+    if args.project:
+        config = ProjectConfig(config=config, project=args.project)
+
+    webhook_use_case = InvoiceWebhookUseCase(logger=logger, config=config)
+    use_case = InvoiceReconciliationUseCase(
+        logger=logger,
+        config=config,
+        webhook_use_case=webhook_use_case,
+    )
+    try:
+        report = use_case.reconcile(
+            after=args.after,
+            before=args.before,
+            output=args.output,
+            reprocess=args.reprocess,
+            reprocess_after=args.reprocess_after,
+        )
+    finally:
+        webhook_use_case.flush_audit()
+
+    logger.info(
+        f"Reconciled {report.credited_invoices} credited invoices and "
+        f"{report.transfers} transfers in {report.elapsed:.1f}s "
+        f"({report.rate:.1f} items/s), found {report.mismatches} mismatches "
+        f"and reprocessed {report.reprocessed} invoices"
+    )
+
+
+if __name__ == "__main__":
+    main()
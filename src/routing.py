@@ -0,0 +1,222 @@
+import json
+import re
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from cache import process_lru_cache
+from clients.starkbank import InvoiceLog, TransferDestination, TransferRoute
+from config import Config
+
+_INFINITY = float("inf")
+
+
+def _normalize_tax_id(tax_id: str) -> str:
+    return re.sub(r"[^0-9A-Za-z]", "", tax_id)
+
+
+def _normalize_tag(tag: str) -> str:
+    return tag.strip().lower()
+
+
+class RoutingRule(NamedTuple):
+    destinations: List[Tuple[TransferDestination, int]]
+    tags: Optional[frozenset] = None
+    tax_id: Optional[str] = None
+    min_amount: Optional[int] = None
+    max_amount: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, rule: dict) -> "RoutingRule":
+        destinations = []
+        for destination in rule.get("destinations") or []:
+            weight = int(destination.get("weight", 1))
+            if weight <= 0:
+                raise ValueError(f"Routing destination weight must be positive: {rule}")
+            destinations.append(
+                (
+                    TransferDestination(
+                        name=destination["name"],
+                        cpf_cnpj=destination["cpf_cnpj"],
+                        bank_code=destination["bank_code"],
+                        branch_code=destination["branch_code"],
+                        account_number=destination["account_number"],
+                        account_type=destination.get("account_type", "checking"),
+                    ),
+                    weight,
+                )
+            )
+        if not destinations:
+            raise ValueError(f"Routing rule without destinations: {rule}")
+
+        min_amount, max_amount = rule.get("min_amount"), rule.get("max_amount")
+        return cls(
+            destinations=destinations,
+            tags=(
+                frozenset(_normalize_tag(tag) for tag in rule["tags"])
+                if rule.get("tags")
+                else None
+            ),
+            tax_id=_normalize_tax_id(rule["tax_id"]) if rule.get("tax_id") else None,
+            min_amount=int(min_amount) if min_amount is not None else None,
+            max_amount=int(max_amount) if max_amount is not None else None,
+        )
+
+    def matches(self, tags: frozenset, tax_id: Optional[str], amount: int) -> bool:
+        return (
+            (self.tags is None or not self.tags.isdisjoint(tags))
+            and (self.tax_id is None or self.tax_id == tax_id)
+            and (self.min_amount is None or self.min_amount <= amount)
+            and (self.max_amount is None or amount < self.max_amount)
+        )
+
+
+class TransferRouter:
+    """Picks the destinations of the net amount of credited invoices
+
+    Rules are matched in order and the first one whose tags (any of them),
+    tax id and amount band [min_amount, max_amount) all match wins, falling
+    back to the default destination. Rules are indexed by their most
+    selective criterion, tags then tax id then amount band, so a routing
+    decision only checks the rules sharing a tag or tax id with the invoice
+    plus a binary search over the amount bands.
+    """
+
+    def __init__(
+        self,
+        rules: Iterable[RoutingRule],
+        default_destination: TransferDestination,
+    ) -> None:
+        self._rules = list(rules)
+        self._default_destination = default_destination
+
+        self._rules_by_tag: Dict[str, List[int]] = {}
+        self._rules_by_tax_id: Dict[str, List[int]] = {}
+        band_rules: List[int] = []
+        self._catch_all_rule: Optional[int] = None
+        for index, rule in enumerate(self._rules):
+            if rule.tags is not None:
+                for tag in rule.tags:
+                    self._rules_by_tag.setdefault(tag, []).append(index)
+            elif rule.tax_id is not None:
+                self._rules_by_tax_id.setdefault(rule.tax_id, []).append(index)
+            elif rule.min_amount is not None or rule.max_amount is not None:
+                band_rules.append(index)
+            elif self._catch_all_rule is None:
+                self._catch_all_rule = index
+
+        # Amount bands may overlap, so they are split on every band boundary
+        # into sorted disjoint segments holding the first rule covering them
+        self._band_boundaries: List[float] = sorted(
+            {-_INFINITY, _INFINITY}
+            | {
+                bound
+                for index in band_rules
+                for bound in (
+                    self._rules[index].min_amount,
+                    self._rules[index].max_amount,
+                )
+                if bound is not None
+            }
+        )
+        self._band_segment_rules: List[Optional[int]] = [None] * (
+            len(self._band_boundaries) - 1
+        )
+        for index in band_rules:
+            rule = self._rules[index]
+            first_segment = bisect_left(
+                self._band_boundaries,
+                rule.min_amount if rule.min_amount is not None else -_INFINITY,
+            )
+            last_segment = bisect_left(
+                self._band_boundaries,
+                rule.max_amount if rule.max_amount is not None else _INFINITY,
+            )
+            for segment in range(first_segment, last_segment):
+                if self._band_segment_rules[segment] is None:
+                    self._band_segment_rules[segment] = index
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def find_rule(
+        self,
+        amount: int,
+        tags: Optional[List[str]] = None,
+        tax_id: Optional[str] = None,
+    ) -> Optional[RoutingRule]:
+        invoice_tags = frozenset(_normalize_tag(tag) for tag in tags or [])
+        invoice_tax_id = _normalize_tax_id(tax_id) if tax_id else None
+
+        def first_match(candidates: Iterable[int]) -> Optional[int]:
+            for index in candidates:
+                if self._rules[index].matches(invoice_tags, invoice_tax_id, amount):
+                    return index
+            return None
+
+        matches = [first_match(self._rules_by_tag.get(tag, ())) for tag in invoice_tags]
+        if invoice_tax_id is not None:
+            matches.append(first_match(self._rules_by_tax_id.get(invoice_tax_id, ())))
+        segment = bisect_right(self._band_boundaries, amount) - 1
+        if 0 <= segment < len(self._band_segment_rules):
+            matches.append(self._band_segment_rules[segment])
+        matches.append(self._catch_all_rule)
+
+        matches = [index for index in matches if index is not None]
+        return self._rules[min(matches)] if matches else None
+
+    def route(self, invoice_log: InvoiceLog, amount: int) -> List[TransferRoute]:
+        """Splits the amount between the destinations of the matching rule by
+        weight, the rounding remainder going to the last destination"""
+        rule = self.find_rule(
+            amount=amount,
+            tags=invoice_log.invoice_tags,
+            tax_id=invoice_log.invoice_tax_id,
+        )
+        if rule is None:
+            return [TransferRoute(destination=self._default_destination, amount=amount)]
+
+        total_weight = sum(weight for _, weight in rule.destinations)
+        routes = []
+        remaining_amount = amount
+        for destination, weight in rule.destinations[:-1]:
+            route_amount = amount * weight // total_weight
+            remaining_amount -= route_amount
+            routes.append(TransferRoute(destination=destination, amount=route_amount))
+        routes.append(
+            TransferRoute(destination=rule.destinations[-1][0], amount=remaining_amount)
+        )
+        return [route for route in routes if route.amount > 0]
+
+
+def _load_routing_rules(config: Config) -> List[dict]:
+    rules = json.loads(config["TRANSFER_ROUTING_RULES"] or "[]")
+    if rules_file := config["TRANSFER_ROUTING_RULES_FILE"]:
+        with open(rules_file) as file:
+            rules.extend(json.load(file))
+    return rules
+
+
+def transfer_router_from_config(config: Config) -> TransferRouter:
+    """Compiles TRANSFER_ROUTING_RULES, then the rules on
+    TRANSFER_ROUTING_RULES_FILE, once per process for each distinct config"""
+    default_destination = TransferDestination(
+        name=config["TRANSFER_DESTINATION_NAME"],
+        cpf_cnpj=config["TRANSFER_DESTINATION_CPF_CNPJ"],
+        bank_code=config["TRANSFER_DESTINATION_BANK_CODE"],
+        branch_code=config["TRANSFER_DESTINATION_BRANCH"],
+        account_number=config["TRANSFER_DESTINATION_ACCOUNT"],
+        account_type=config["TRANSFER_DESTINATION_ACCOUNT_TYPE"],
+    )
+    routers = process_lru_cache("transfer-routers", maxsize=8)
+    router_key = (
+        config["TRANSFER_ROUTING_RULES"],
+        config["TRANSFER_ROUTING_RULES_FILE"],
+        default_destination,
+    )
+    if (router := routers.get(router_key)) is None:
+        router = TransferRouter(
+            rules=[RoutingRule.from_dict(rule) for rule in _load_routing_rules(config)],
+            default_destination=default_destination,
+        )
+        routers.set(router_key, router)
+    return router
@@ -1,10 +1,36 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from logging import Logger
-from typing import Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import redis
 
-from clients.starkbank import InvalidDigitalSignature, StarkBankAdapter
-from config import Config
+from audit import AuditRecord, audit_buffer_from_config, now_isoformat, timed
+from cache import ReadThroughCache, process_lru_cache
+from clients.starkbank import (
+    DuplicatedTransfer,
+    InvalidDigitalSignature,
+    InvoiceLog,
+    StarkBankAdapter,
+    WebhookEvent,
+)
+from config import Config, as_bool
+from dedup import KeyDedupStore, dedup_store_from_config
+from routing import transfer_router_from_config
+
+_payment_lookup_executor: Optional[ThreadPoolExecutor] = None
+_payment_lookup_executor_lock = threading.Lock()
+
+
+def _get_payment_lookup_executor(max_workers: int) -> ThreadPoolExecutor:
+    global _payment_lookup_executor
+    with _payment_lookup_executor_lock:
+        if _payment_lookup_executor is None:
+            _payment_lookup_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="payment-lookup"
+            )
+    return _payment_lookup_executor
 
 
 class InvoiceWebhookUseCase:
@@ -17,21 +43,139 @@ class InvoiceWebhookUseCase:
     ) -> None:
         self._logger = logger
         self._config = config
-        self._sb_adapter = adapter_class(config=config)
 
-        self._redis_client = redis_client_class(
-            host=config["REDIS_HOST"],
-            port=config["REDIS_PORT"],
-            password=config["REDIS_PASSWORD"],
+        # Clients are kept by the process so their connection pool, and the
+        # connections already authenticated, outlive the invocation
+        redis_clients = process_lru_cache("redis-clients", maxsize=8)
+        redis_client_key = (
+            redis_client_class,
+            config["REDIS_HOST"],
+            config["REDIS_PORT"],
+            config["REDIS_PASSWORD"],
+        )
+        if (redis_client := redis_clients.get(redis_client_key)) is None:
+            redis_client = redis_client_class(
+                host=config["REDIS_HOST"],
+                port=config["REDIS_PORT"],
+                password=config["REDIS_PASSWORD"],
+            )
+            redis_clients.set(redis_client_key, redis_client)
+        self._redis_client = redis_client
+        self._dedup_store = dedup_store_from_config(
+            redis_client=self._redis_client, config=config
+        )
+        # Kept apart from event ids, which may be stored as integers on sets
+        self._reprocess_dedup_store = KeyDedupStore(
+            redis_client=self._redis_client,
+            expiration=int(config["DUPLICATED_EVENT_VALIDATION_EXP"] or 36000),
+            key_prefix="starkbank-reprocessed-invoice:",
+        )
+        self._transfer_router = transfer_router_from_config(config)
+        self._audit_buffer = audit_buffer_from_config(
+            redis_client=self._redis_client, config=config
+        )
+
+        sb_adapters = process_lru_cache(
+            "starkbank-adapters",
+            maxsize=int(config["STARKBANK_ADAPTERS_CACHE_SIZE"] or 16),
+        )
+        if (sb_adapter := sb_adapters.get((adapter_class, config.project))) is None:
+            sb_adapter = self._build_sb_adapter(adapter_class=adapter_class)
+            sb_adapters.set((adapter_class, config.project), sb_adapter)
+        self._sb_adapter = sb_adapter
+
+    @property
+    def sb_adapter(self) -> StarkBankAdapter:
+        return self._sb_adapter
+
+    def warm_up(self) -> Dict[str, float]:
+        """Opens the connections used by webhooks, returning the seconds each
+        step took. Never touches processed events or creates transfers"""
+        timings = {}
+
+        started_at = time.perf_counter()
+        self._redis_client.ping()
+        timings["redis"] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        self._sb_adapter.fetch_public_key()
+        timings["public_key"] = time.perf_counter() - started_at
+
+        return timings
+
+    def _build_sb_adapter(self, adapter_class) -> StarkBankAdapter:
+        # Projects, and sandbox and production, never share cached entries
+        cache_namespace = (
+            f"{self._config['STARKBANK_ENVIRONMENT']}:{self._config.project or ''}"
+        )
+        payment_amount_cache_exp = int(
+            self._config["INVOICE_PAYMENT_CACHE_EXP"] or 86400
+        )
+        payment_amount_cache = ReadThroughCache(
+            local=process_lru_cache(
+                f"invoice-payment-amount:{cache_namespace}",
+                maxsize=int(self._config["INVOICE_PAYMENT_CACHE_SIZE"] or 1024),
+                ttl=payment_amount_cache_exp,
+            ),
+            redis_client=(
+                self._redis_client
+                if as_bool(self._config["INVOICE_PAYMENT_CACHE_REDIS"])
+                else None
+            ),
+            key_prefix=f"starkbank-invoice-payment-amount:{cache_namespace}:",
+            ttl=payment_amount_cache_exp,
+        )
+
+        verified_event_cache_exp = int(self._config["SIGNATURE_CACHE_EXP"] or 3600)
+        verified_event_cache = ReadThroughCache(
+            local=process_lru_cache(
+                f"verified-webhook-event:{cache_namespace}",
+                maxsize=int(self._config["SIGNATURE_CACHE_SIZE"] or 1024),
+                ttl=verified_event_cache_exp,
+            ),
+            redis_client=(
+                self._redis_client
+                if as_bool(self._config["SIGNATURE_CACHE_REDIS"])
+                else None
+            ),
+            key_prefix=f"starkbank-verified-webhook-event:{cache_namespace}:",
+            ttl=verified_event_cache_exp,
+        )
+
+        return adapter_class(
+            config=self._config,
+            payment_amount_cache=payment_amount_cache,
+            verified_event_cache=verified_event_cache,
         )
 
     def process_invoice_credited_webhook(
         self, event_body: Optional[str], event_headers: dict
     ) -> Tuple[int, str, str]:
+        audit: Dict[str, Any] = {"timings": {}}
+        try:
+            with timed(audit["timings"], "total"):
+                status_code, response_message, log_message = (
+                    self._process_invoice_credited_webhook(
+                        event_body=event_body, event_headers=event_headers, audit=audit
+                    )
+                )
+        except Exception:
+            self._record_audit(status_code=500, **{"outcome": "error", **audit})
+            raise
+
+        self._record_audit(status_code=status_code, **audit)
+        return status_code, response_message, log_message
+
+    def _process_invoice_credited_webhook(
+        self, event_body: Optional[str], event_headers: dict, audit: Dict[str, Any]
+    ) -> Tuple[int, str, str]:
+        timings = audit["timings"]
         if not event_body:
+            audit["outcome"] = "missing_body"
             return 400, "Request must contain body", "Received a request without body"
 
         if not (digital_signature := event_headers.get("Digital-Signature")):
+            audit["outcome"] = "missing_signature"
             return (
                 401,
                 "Digital-Signature not provided on headers, can not confirm webhook authenticity",
@@ -39,26 +183,27 @@ class InvoiceWebhookUseCase:
             )
 
         try:
-            starkbank_event_entity, event_id = (
-                self._sb_adapter.get_event_entity_and_id_from_body(
+            with timed(timings, "signature"):
+                webhook_event = self._sb_adapter.get_webhook_event_from_body(
                     event_body=event_body, digital_signature=digital_signature
                 )
-            )
         except InvalidDigitalSignature:
+            audit["outcome"] = "invalid_signature"
             return (
                 401,
                 "Invalid Digital-Signature",
                 "Received a request with invalid Digital-Signature headers",
             )
 
-        event_id_setted = self._redis_client.set(
-            f"starkbank-event-id:{event_id}",
-            1,
-            nx=True,
-            ex=self._config["DUPLICATED_EVENT_VALIDATION_EXP"],
-        )
+        invoice_log_lookup = self._start_speculative_payment_lookup(webhook_event)
 
-        if not event_id_setted:
+        event_id = audit["event_id"] = webhook_event.id
+        with timed(timings, "dedup"):
+            processed_before = not self._dedup_store.mark_as_processed(event_id)
+        if processed_before:
+            if invoice_log_lookup:
+                invoice_log_lookup.cancel()
+            audit["outcome"] = "duplicated"
             return (
                 200,
                 "Ok",
@@ -67,13 +212,20 @@ class InvoiceWebhookUseCase:
 
         self._logger.info(f"Processing event with id {event_id}")
 
-        invoice_log = self._sb_adapter.get_invoice_data_from_event_entity(
-            event_entity=starkbank_event_entity
-        )
+        with timed(timings, "invoice"):
+            if invoice_log_lookup:
+                invoice_log = invoice_log_lookup.result()
+            else:
+                invoice_log = self._sb_adapter.get_invoice_data_from_webhook_event(
+                    webhook_event=webhook_event
+                )
         if not invoice_log:
+            audit["outcome"] = "not_invoice"
             return 200, "Ok", "Received event was not related with invoice"
 
+        audit["invoice_log"] = invoice_log
         if not invoice_log.paid_amount:
+            audit["outcome"] = "not_credited"
             return (
                 200,
                 "Ok",
@@ -83,18 +235,169 @@ class InvoiceWebhookUseCase:
         self._logger.info(
             f"Invoice with id {invoice_log.invoice_id} paid with {invoice_log.paid_amount} and fee {invoice_log.invoice_fee}"
         )
+        if invoice_log.paid_amount <= invoice_log.invoice_fee:
+            audit["outcome"] = "fee_not_covered"
+            return (
+                200,
+                "Ok",
+                f"Invoice with id {invoice_log.invoice_id} paid amount does not cover its fee, no transfer created",
+            )
+
+        try:
+            with timed(timings, "transfer"):
+                transfer_ids = self.create_invoice_transfer(invoice_log=invoice_log)
+        except DuplicatedTransfer as error:
+            audit["transfer_ids"] = error.transfer_ids
+            audit["outcome"] = "already_transferred"
+            return (
+                200,
+                "Ok",
+                f"Invoice with id {invoice_log.invoice_id} already has transfers with ids {', '.join(error.transfer_ids)}",
+            )
+        audit["transfer_ids"] = transfer_ids
+        audit["outcome"] = "transferred"
+
+        if len(transfer_ids) == 1:
+            return 200, "Ok", f"Created transfer with id {transfer_ids[0]}"
+        return 200, "Ok", f"Created transfers with ids {', '.join(transfer_ids)}"
+
+    def _record_audit(
+        self,
+        outcome: str,
+        status_code: int,
+        timings: Dict[str, float],
+        event_id: Optional[str] = None,
+        invoice_log: Optional[InvoiceLog] = None,
+        transfer_ids: Optional[List[str]] = None,
+    ) -> None:
+        if self._audit_buffer is None:
+            return
+
+        self._audit_buffer.record(
+            AuditRecord(
+                recorded_at=now_isoformat(),
+                outcome=outcome,
+                status_code=status_code,
+                project=self._config.project,
+                event_id=event_id,
+                invoice_id=invoice_log.invoice_id if invoice_log else None,
+                paid_amount=invoice_log.paid_amount if invoice_log else None,
+                invoice_fee=invoice_log.invoice_fee if invoice_log else None,
+                transfer_ids=transfer_ids,
+                timings=timings,
+            )
+        )
+
+    def flush_audit(self) -> int:
+        """Writes the buffered audit records, returning how many were written"""
+        if self._audit_buffer is None:
+            return 0
+
+        flushed = self._audit_buffer.flush()
+        if pending := len(self._audit_buffer):
+            self._logger.warning(
+                f"Could not write {pending} audit records, "
+                f"{self._audit_buffer.dropped} dropped so far"
+            )
+        return flushed
+
+    def _start_speculative_payment_lookup(
+        self, webhook_event: WebhookEvent
+    ) -> Optional["Future[Optional[InvoiceLog]]"]:
+        """Looks up the payment of credited invoices while the event id is
+        written on the dedup store, the result is discarded for duplicates"""
+        if not as_bool(self._config["SPECULATIVE_PAYMENT_LOOKUP"]) or (
+            webhook_event.subscription != "invoice"
+            or webhook_event.log_type != "credited"
+        ):
+            return None
+
+        executor = _get_payment_lookup_executor(
+            max_workers=int(self._config["SPECULATIVE_PAYMENT_LOOKUP_WORKERS"] or 4)
+        )
+        return executor.submit(
+            self._sb_adapter.get_invoice_data_from_webhook_event,
+            webhook_event=webhook_event,
+        )
+
+    def create_invoice_transfer(
+        self, invoice_log: InvoiceLog, attempt: int = 0
+    ) -> List[str]:
         amount = invoice_log.paid_amount - invoice_log.invoice_fee
-        self._logger.info(f"Creating a transfer with value {amount}")
-
-        transfer_id = self._sb_adapter.create_transfer(
-            amount=amount,
-            cpf_cnpj=self._config["TRANSFER_DESTINATION_CPF_CNPJ"],
-            name=self._config["TRANSFER_DESTINATION_NAME"],
-            bank_code=self._config["TRANSFER_DESTINATION_BANK_CODE"],
-            branch_code=self._config["TRANSFER_DESTINATION_BRANCH"],
-            account_number=self._config["TRANSFER_DESTINATION_ACCOUNT"],
-            account_type=self._config["TRANSFER_DESTINATION_ACCOUNT_TYPE"],
+        if amount <= 0:
+            raise ValueError(
+                f"Invoice with id {invoice_log.invoice_id} has no amount to transfer"
+            )
+
+        routes = self._transfer_router.route(invoice_log=invoice_log, amount=amount)
+        self._logger.info(
+            f"Creating {len(routes)} transfers with values "
+            f"{', '.join(str(route.amount) for route in routes)}"
+        )
+
+        return self._sb_adapter.create_transfers(
+            routes=routes,
             tag=self._config["TRANSFERS_TAG"],
+            invoice_id=invoice_log.invoice_id,
+            attempt=attempt,
+        )
+
+    def reprocess_credited_invoice(
+        self,
+        invoice_id: str,
+        invoice_fee: int,
+        invoice_tags: Optional[List[str]] = None,
+        invoice_tax_id: Optional[str] = None,
+    ) -> Optional[List[str]]:
+        if not self._reprocess_dedup_store.mark_as_processed(invoice_id):
+            self._logger.info(f"Invoice with id {invoice_id} was already reprocessed")
+            return None
+
+        # Transfers of the invoice may have been created at any time
+        invoice_transfers = list(self._sb_adapter.get_invoice_transfers(invoice_id))
+        if existing_transfer_ids := [
+            transfer.id for transfer in invoice_transfers if transfer.status != "failed"
+        ]:
+            self._logger.info(
+                f"Invoice with id {invoice_id} already has transfers with ids "
+                f"{', '.join(existing_transfer_ids)}, will not be reprocessed"
+            )
+            return None
+
+        invoice_log = self._sb_adapter.get_invoice_log(
+            log_type="credited",
+            invoice_fee=invoice_fee,
+            invoice_id=invoice_id,
+            invoice_tags=invoice_tags,
+            invoice_tax_id=invoice_tax_id,
         )
+        if invoice_log.paid_amount <= invoice_log.invoice_fee:
+            self._logger.info(
+                f"Invoice with id {invoice_id} paid amount does not cover its fee, "
+                "will not be reprocessed"
+            )
+            return None
 
-        return 200, "Ok", f"Created transfer with id {transfer_id}"
+        timings: Dict[str, float] = {}
+        try:
+            with timed(timings, "transfer"):
+                # Failed transfers keep their external ids, so an invoice whose
+                # transfers failed is retried with new ones
+                transfer_ids = self.create_invoice_transfer(
+                    invoice_log=invoice_log, attempt=len(invoice_transfers)
+                )
+        except DuplicatedTransfer as error:
+            self._logger.info(
+                f"Invoice with id {invoice_id} already has transfers with ids "
+                f"{', '.join(error.transfer_ids)}, will not be reprocessed"
+            )
+            return None
+
+        self._record_audit(
+            outcome="reprocessed",
+            status_code=200,
+            timings=timings,
+            invoice_log=invoice_log,
+            transfer_ids=transfer_ids,
+        )
+        return transfer_ids
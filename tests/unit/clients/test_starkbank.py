@@ -1,10 +1,31 @@
 import datetime
+import hashlib
+import json
 from unittest import mock
 
 import pytest
 import starkbank
 
-from src.clients.starkbank import InvalidDigitalSignature, InvoiceLog, StarkBankAdapter
+from src.cache import LRUCache, ReadThroughCache
+from src.clients.starkbank import (
+    DuplicatedTransfer,
+    InvalidDigitalSignature,
+    InvoiceLog,
+    StarkBankAdapter,
+    TransferDestination,
+    TransferRoute,
+    WebhookEvent,
+    get_invoice_id_from_transfer_tags,
+)
+
+DESTINATION = TransferDestination(
+    name="Fulano da Silva",
+    cpf_cnpj="123.456.789-00",
+    bank_code="123",
+    branch_code="123456-7",
+    account_number="134567-8",
+    account_type="checking",
+)
 
 
 @pytest.fixture
@@ -58,6 +79,303 @@ class TestStarkBankAdapterGetEventEntityAndIdFromBody:
         event_parse_mock.assert_called_once()
 
 
+@mock.patch("src.clients.starkbank._verify_signature")
+class TestStarkBankAdapterGetWebhookEventFromBody:
+    def test_success(
+        self, verify_signature_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        event_body = json.dumps(event_content_invoice_credited)
+        verify_signature_mock.return_value = event_body
+
+        result = sb_adapter.get_webhook_event_from_body(
+            event_body=event_body, digital_signature="Signature"
+        )
+
+        assert result == WebhookEvent(
+            id="6046987522670592",
+            subscription="invoice",
+            log_type="credited",
+            invoice_id="5807638394699776",
+            invoice_fee=100,
+            invoice_tags=["war supply", "invoice #1234"],
+            invoice_tax_id="20.018.183/0001-80",
+            content=event_body,
+        )
+        verify_signature_mock.assert_called_once_with(
+            content=event_body, signature="Signature", user=sb_adapter._user
+        )
+
+    def test_subscription_other_than_invoice(
+        self, verify_signature_mock, event_content_boleto_holmes, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        event_body = json.dumps(event_content_boleto_holmes)
+        verify_signature_mock.return_value = event_body
+
+        result = sb_adapter.get_webhook_event_from_body(
+            event_body=event_body, digital_signature="Signature"
+        )
+
+        assert result.subscription == "boleto-holmes"
+        assert result.invoice_id is None
+        assert result.invoice_fee is None
+
+    def test_invalid_signature(self, verify_signature_mock, testing_config):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        verify_signature_mock.side_effect = starkbank.error.InvalidSignatureError()
+
+        with pytest.raises(InvalidDigitalSignature):
+            sb_adapter.get_webhook_event_from_body(
+                event_body="{}", digital_signature="Signature"
+            )
+
+
+@mock.patch("src.clients.starkbank._verify_signature")
+class TestStarkBankAdapterGetWebhookEventFromBodyCached:
+    def test_verifies_repeated_delivery_once(
+        self, verify_signature_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            verified_event_cache=ReadThroughCache(local=LRUCache(maxsize=2)),
+        )
+        event_body = json.dumps(event_content_invoice_credited)
+        verify_signature_mock.return_value = event_body
+
+        results = [
+            sb_adapter.get_webhook_event_from_body(
+                event_body=event_body, digital_signature="Signature"
+            )
+            for _ in range(2)
+        ]
+
+        assert results[0] == results[1] == WebhookEvent.from_content(event_body)
+        verify_signature_mock.assert_called_once()
+
+    def test_verifies_different_signature(
+        self, verify_signature_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            verified_event_cache=ReadThroughCache(local=LRUCache(maxsize=2)),
+        )
+        event_body = json.dumps(event_content_invoice_credited)
+        verify_signature_mock.return_value = event_body
+        sb_adapter.get_webhook_event_from_body(
+            event_body=event_body, digital_signature="Signature"
+        )
+        verify_signature_mock.side_effect = starkbank.error.InvalidSignatureError()
+
+        for _ in range(2):
+            with pytest.raises(InvalidDigitalSignature):
+                sb_adapter.get_webhook_event_from_body(
+                    event_body=event_body, digital_signature="OtherSignature"
+                )
+
+        assert verify_signature_mock.call_count == 3
+
+    def test_shares_verified_events_through_redis(
+        self, verify_signature_mock, event_content_invoice_credited, testing_config
+    ):
+        import fakeredis
+
+        redis_client = fakeredis.FakeRedis()
+        sb_adapters = [
+            StarkBankAdapter(
+                config=testing_config,
+                verified_event_cache=ReadThroughCache(
+                    local=LRUCache(maxsize=2), redis_client=redis_client, ttl=60
+                ),
+            )
+            for _ in range(2)
+        ]
+        event_body = json.dumps(event_content_invoice_credited)
+        verify_signature_mock.return_value = event_body
+
+        results = [
+            sb_adapter.get_webhook_event_from_body(
+                event_body=event_body, digital_signature="Signature"
+            )
+            for sb_adapter in sb_adapters
+        ]
+
+        assert results[0] == results[1] == WebhookEvent.from_content(event_body)
+        verify_signature_mock.assert_called_once()
+        redis_client.flushall()
+
+    @pytest.mark.parametrize(
+        "cached_value",
+        [
+            b'["6046987522670592", "invoice", "credited", "5807638394699776", 100]',
+            b"not json",
+        ],
+    )
+    def test_verifies_again_entries_of_other_formats(
+        self,
+        verify_signature_mock,
+        event_content_invoice_credited,
+        testing_config,
+        cached_value,
+    ):
+        import fakeredis
+
+        redis_client = fakeredis.FakeRedis()
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            verified_event_cache=ReadThroughCache(
+                local=LRUCache(maxsize=2), redis_client=redis_client, ttl=60
+            ),
+        )
+        event_body = json.dumps(event_content_invoice_credited)
+        verify_signature_mock.return_value = event_body
+        digest = hashlib.sha256(f"Signature\0{event_body}".encode()).hexdigest()
+        redis_client.set(digest, cached_value)
+
+        result = sb_adapter.get_webhook_event_from_body(
+            event_body=event_body, digital_signature="Signature"
+        )
+
+        assert result == WebhookEvent.from_content(event_body)
+        verify_signature_mock.assert_called_once()
+        assert json.loads(redis_client.get(digest))["invoice_tags"] == [
+            "war supply",
+            "invoice #1234",
+        ]
+        redis_client.flushall()
+
+    def test_rebuilds_entries_missing_newer_fields(
+        self, verify_signature_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            verified_event_cache=ReadThroughCache(local=LRUCache(maxsize=2)),
+        )
+        event_body = json.dumps(event_content_invoice_credited)
+        digest = hashlib.sha256(f"Signature\0{event_body}".encode()).hexdigest()
+        sb_adapter._verified_event_cache.set(
+            digest,
+            {
+                "id": "6046987522670592",
+                "subscription": "invoice",
+                "log_type": "credited",
+                "invoice_id": "5807638394699776",
+                "invoice_fee": 100,
+            },
+        )
+
+        result = sb_adapter.get_webhook_event_from_body(
+            event_body=event_body, digital_signature="Signature"
+        )
+
+        assert result.invoice_id == "5807638394699776"
+        assert result.invoice_tags is None
+        assert result.content == event_body
+        verify_signature_mock.assert_not_called()
+
+
+class TestWebhookEventToEntity:
+    def test_builds_sdk_event(self, event_content_invoice_credited):
+        webhook_event = WebhookEvent.from_content(
+            json.dumps(event_content_invoice_credited)
+        )
+
+        event = webhook_event.to_entity()
+
+        assert isinstance(event, starkbank.Event)
+        assert event.id == webhook_event.id
+        assert event.log.type == webhook_event.log_type
+        assert event.log.invoice.id == webhook_event.invoice_id
+        assert event.log.invoice.tags == ["war supply", "invoice #1234"]
+
+
+@mock.patch.object(starkbank.invoice, "payment")
+class TestStarkBankAdapterGetInvoiceDataFromWebhookEvent:
+    def test_invoice_credited(
+        self, invoice_payment_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        invoice_payment_mock.return_value = mock.Mock(amount=10100)
+        webhook_event = WebhookEvent.from_content(
+            json.dumps(event_content_invoice_credited)
+        )
+
+        result = sb_adapter.get_invoice_data_from_webhook_event(
+            webhook_event=webhook_event
+        )
+
+        assert result == InvoiceLog(
+            log_type="credited",
+            invoice_fee=100,
+            invoice_id="5807638394699776",
+            paid_amount=10100,
+            invoice_tags=["war supply", "invoice #1234"],
+            invoice_tax_id="20.018.183/0001-80",
+        )
+        invoice_payment_mock.assert_called_once_with(
+            "5807638394699776", user=sb_adapter._user
+        )
+
+    def test_invoice_credited_payment_amount_cached(
+        self, invoice_payment_mock, event_content_invoice_credited, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            payment_amount_cache=ReadThroughCache(local=LRUCache(maxsize=2)),
+        )
+        invoice_payment_mock.return_value = mock.Mock(amount=10100)
+        webhook_event = WebhookEvent.from_content(
+            json.dumps(event_content_invoice_credited)
+        )
+
+        results = [
+            sb_adapter.get_invoice_data_from_webhook_event(webhook_event=webhook_event)
+            for _ in range(2)
+        ]
+
+        assert results[0].paid_amount == results[1].paid_amount == 10100
+        invoice_payment_mock.assert_called_once_with(
+            "5807638394699776", user=sb_adapter._user
+        )
+
+    def test_invoice_other_than_credited(
+        self, invoice_payment_mock, event_content_invoice_created, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        webhook_event = WebhookEvent.from_content(
+            json.dumps(event_content_invoice_created)
+        )
+
+        result = sb_adapter.get_invoice_data_from_webhook_event(
+            webhook_event=webhook_event
+        )
+
+        assert result == InvoiceLog(
+            log_type="created",
+            invoice_fee=100,
+            invoice_id="5807638394699776",
+            paid_amount=None,
+            invoice_tags=["war supply", "invoice #1234"],
+            invoice_tax_id="20.018.183/0001-80",
+        )
+        invoice_payment_mock.assert_not_called()
+
+    def test_subscription_other_than_invoice(
+        self, invoice_payment_mock, event_content_boleto_holmes, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        webhook_event = WebhookEvent.from_content(
+            json.dumps(event_content_boleto_holmes)
+        )
+
+        result = sb_adapter.get_invoice_data_from_webhook_event(
+            webhook_event=webhook_event
+        )
+
+        assert result is None
+        invoice_payment_mock.assert_not_called()
+
+
 @mock.patch.object(starkbank.invoice, "payment")
 class TestStarkBankAdapterGetInvoiceDataFromEventEntity:
     def test_invoice_credited(
@@ -88,10 +406,46 @@ class TestStarkBankAdapterGetInvoiceDataFromEventEntity:
             log_type=event_entity_invoice_credited.log.type,
             invoice_fee=event_entity_invoice_credited.log.invoice.fee,
             invoice_id=event_entity_invoice_credited.log.invoice.id,
+            invoice_tags=event_entity_invoice_credited.log.invoice.tags,
+            invoice_tax_id=event_entity_invoice_credited.log.invoice.tax_id,
             paid_amount=payment.amount,
         )
         invoice_payment_mock.assert_called_once_with(
-            event_entity_invoice_credited.log.invoice.id
+            event_entity_invoice_credited.log.invoice.id, user=sb_adapter._user
+        )
+
+    def test_invoice_credited_payment_amount_cached(
+        self,
+        invoice_payment_mock,
+        event_entity_invoice_credited,
+        testing_config,
+    ):
+        sb_adapter = StarkBankAdapter(
+            config=testing_config,
+            payment_amount_cache=ReadThroughCache(local=LRUCache(maxsize=2)),
+        )
+        invoice_payment_mock.return_value = starkbank.invoice.Payment(
+            amount=10100,
+            name="Fulano da Silva",
+            tax_id="12345678900",
+            bank_code="123",
+            branch_code="123456-7",
+            account_number="1234567-8",
+            account_type="checking",
+            end_to_end_id="ABC123",
+            method="pix",
+        )
+
+        first_result = sb_adapter.get_invoice_data_from_event_entity(
+            event_entity=event_entity_invoice_credited
+        )
+        second_result = sb_adapter.get_invoice_data_from_event_entity(
+            event_entity=event_entity_invoice_credited
+        )
+
+        assert first_result.paid_amount == second_result.paid_amount == 10100
+        invoice_payment_mock.assert_called_once_with(
+            event_entity_invoice_credited.log.invoice.id, user=sb_adapter._user
         )
 
     def test_invoice_other_than_credited(
@@ -110,6 +464,8 @@ class TestStarkBankAdapterGetInvoiceDataFromEventEntity:
             log_type=event_entity_invoice_created.log.type,
             invoice_fee=event_entity_invoice_created.log.invoice.fee,
             invoice_id=event_entity_invoice_created.log.invoice.id,
+            invoice_tags=event_entity_invoice_created.log.invoice.tags,
+            invoice_tax_id=event_entity_invoice_created.log.invoice.tax_id,
             paid_amount=None,
         )
         invoice_payment_mock.assert_not_called()
@@ -171,3 +527,207 @@ class TestStarkBankAdapterCreateTransfer:
         assert transfers[0].account_number == transfer_args["account_number"]
         assert transfers[0].account_type == transfer_args["account_type"]
         assert transfers[0].tags == [transfer_args["tag"]]
+        assert transfer_create_mock.call_args.kwargs["user"] == sb_adapter._user
+
+    def test_tags_invoice_id(self, transfer_create_mock, testing_config):
+        transfer_create_mock.return_value = [mock.Mock(id="123")]
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        sb_adapter.create_transfer(
+            amount=100000,
+            cpf_cnpj="123.456.789-00",
+            name="Fulano da Silva",
+            bank_code="123",
+            branch_code="123456-7",
+            account_number="134567-8",
+            account_type="checking",
+            tag="testing",
+            invoice_id="5807638394699776",
+        )
+
+        transfer = transfer_create_mock.call_args.args[0][0]
+        assert transfer.tags == ["testing", "invoice-5807638394699776"]
+        assert get_invoice_id_from_transfer_tags(transfer.tags) == "5807638394699776"
+
+
+@mock.patch.object(starkbank.transfer, "create")
+class TestStarkBankAdapterCreateTransfers:
+    def test_success(self, transfer_create_mock, testing_config):
+        transfer_result = starkbank.Transfer(
+            amount=10000,
+            name="Fulano da Silva",
+            tax_id="123.456.789-00",
+            bank_code="123",
+            branch_code="123456-7",
+            account_number="134567-8",
+            account_type="checking",
+            id="123",
+        )
+
+        transfer_create_mock.return_value = [transfer_result]
+
+        destination = TransferDestination(
+            name="Fulano da Silva",
+            cpf_cnpj="123.456.789-00",
+            bank_code="123",
+            branch_code="123456-7",
+            account_number="134567-8",
+            account_type="checking",
+        )
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        result = sb_adapter.create_transfers(
+            routes=[TransferRoute(destination=destination, amount=100000)],
+            tag="testing",
+        )
+
+        assert result == [transfer_result.id]
+        transfers = transfer_create_mock.call_args.args[0]
+        assert len(transfers) == 1
+        assert transfers[0].amount == 100000
+        assert transfers[0].tax_id == destination.cpf_cnpj
+        assert transfers[0].name == destination.name
+        assert transfers[0].bank_code == destination.bank_code
+        assert transfers[0].branch_code == destination.branch_code
+        assert transfers[0].account_number == destination.account_number
+        assert transfers[0].account_type == destination.account_type
+        assert transfers[0].tags == ["testing"]
+        assert transfer_create_mock.call_args.kwargs["user"] == sb_adapter._user
+
+    def test_create_transfers_in_one_request(
+        self, transfer_create_mock, testing_config
+    ):
+        transfer_create_mock.return_value = [mock.Mock(id="123"), mock.Mock(id="124")]
+        sb_adapter = StarkBankAdapter(config=testing_config)
+        destination = TransferDestination(
+            name="Fulano da Silva",
+            cpf_cnpj="123.456.789-00",
+            bank_code="123",
+            branch_code="123456-7",
+            account_number="134567-8",
+            account_type="checking",
+        )
+
+        result = sb_adapter.create_transfers(
+            routes=[
+                TransferRoute(destination=destination, amount=3300),
+                TransferRoute(
+                    destination=destination._replace(account_number="7654321-0"),
+                    amount=6600,
+                ),
+            ],
+            tag="testing",
+            invoice_id="5807638394699776",
+        )
+
+        assert result == ["123", "124"]
+        transfer_create_mock.assert_called_once()
+        transfers = transfer_create_mock.call_args.args[0]
+        assert [transfer.amount for transfer in transfers] == [3300, 6600]
+        assert [transfer.account_number for transfer in transfers] == [
+            "134567-8",
+            "7654321-0",
+        ]
+        assert all(
+            transfer.tags == ["testing", "invoice-5807638394699776"]
+            for transfer in transfers
+        )
+        assert (
+            get_invoice_id_from_transfer_tags(transfers[0].tags) == "5807638394699776"
+        )
+        assert [transfer.external_id for transfer in transfers] == [
+            "invoice-5807638394699776-0",
+            "invoice-5807638394699776-1",
+        ]
+
+    def test_retry_attempt_external_ids(self, transfer_create_mock, testing_config):
+        transfer_create_mock.return_value = [mock.Mock(id="123")]
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        sb_adapter.create_transfers(
+            routes=[TransferRoute(destination=DESTINATION, amount=3300)],
+            invoice_id="5807638394699776",
+            attempt=2,
+        )
+
+        transfers = transfer_create_mock.call_args.args[0]
+        assert transfers[0].external_id == "invoice-5807638394699776-0-2"
+
+    @mock.patch.object(starkbank.transfer, "query")
+    def test_duplicated_external_ids(
+        self, transfer_query_mock, transfer_create_mock, testing_config
+    ):
+        transfer_create_mock.side_effect = starkbank.error.InputErrors(
+            [{"code": "invalidExternalId", "message": "Repeated external id"}]
+        )
+        transfer_query_mock.return_value = iter(
+            [
+                mock.Mock(id="122", status="failed"),
+                mock.Mock(id="123", status="success"),
+            ]
+        )
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        with pytest.raises(DuplicatedTransfer) as error:
+            sb_adapter.create_transfers(
+                routes=[TransferRoute(destination=DESTINATION, amount=3300)],
+                invoice_id="5807638394699776",
+            )
+
+        assert error.value.transfer_ids == ["123"]
+
+    @mock.patch.object(starkbank.transfer, "query")
+    def test_input_errors_without_transfers(
+        self, transfer_query_mock, transfer_create_mock, testing_config
+    ):
+        transfer_create_mock.side_effect = starkbank.error.InputErrors(
+            [{"code": "invalidAccountNumber", "message": "Invalid account number"}]
+        )
+        transfer_query_mock.return_value = iter([])
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        with pytest.raises(starkbank.error.InputErrors):
+            sb_adapter.create_transfers(
+                routes=[TransferRoute(destination=DESTINATION, amount=3300)],
+                invoice_id="5807638394699776",
+            )
+
+
+@mock.patch.object(starkbank.transfer, "query")
+class TestStarkBankAdapterGetInvoiceTransfers:
+    def test_queries_by_invoice_tag_without_dates(
+        self, transfer_query_mock, testing_config
+    ):
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        sb_adapter.get_invoice_transfers("5807638394699776")
+
+        transfer_query_mock.assert_called_once_with(
+            tags=["invoice-5807638394699776"], user=sb_adapter._user
+        )
+
+
+class TestGetInvoiceIdFromTransferTags:
+    def test_without_invoice_tag(self):
+        assert get_invoice_id_from_transfer_tags(["testing"]) is None
+        assert get_invoice_id_from_transfer_tags(None) is None
+
+
+@mock.patch("starkcore.utils.parse.get_raw")
+class TestStarkBankAdapterFetchPublicKey:
+    def test_caches_public_key(self, get_raw_mock, testing_config):
+        from ellipticcurve import PrivateKey
+        from starkcore.utils.cache import cache
+
+        public_key = PrivateKey().publicKey()
+        get_raw_mock.return_value.json.return_value = {
+            "publicKeys": [{"content": public_key.toPem()}]
+        }
+        sb_adapter = StarkBankAdapter(config=testing_config)
+
+        with mock.patch.dict(cache, clear=True):
+            sb_adapter.fetch_public_key()
+
+            assert cache["stark-public-key"].toPem() == public_key.toPem()
+        assert get_raw_mock.call_args.kwargs["path"] == "/public-key"
+        assert get_raw_mock.call_args.kwargs["user"] == sb_adapter._user
@@ -1,8 +1,15 @@
 import json
 from unittest import mock
 
+import pytest
+
 from src.app import lambda_handler
 
+DIGITAL_SIGNATURE = (
+    "MEQCIFzY+PQvIJZOKHJzWvT0ALV44+zJFuqNsdBX0u+IZLaZ"
+    "AiAjuKTCMxr3WGWGt74ZdE0jDuD8I4ZE0N5X1JnPisXu9g=="
+)
+
 
 @mock.patch("src.app.InvoiceWebhookUseCase.process_invoice_credited_webhook")
 class TestLambdaHandler:
@@ -16,7 +23,7 @@ class TestLambdaHandler:
             "resource": "/webhook",
             "path": "/webhook",
             "httpMethod": "POST",
-            "headers": {"Digital-Signature": "Signature"},
+            "headers": {"Digital-Signature": DIGITAL_SIGNATURE},
             "multiValueHeaders": {},
             "queryStringParameters": {},
             "multiValueQueryStringParameters": {},
@@ -65,3 +72,201 @@ class TestLambdaHandler:
             event_body=lambda_event["body"],
             event_headers=lambda_event["headers"],
         )
+
+
+@mock.patch("src.app.InvoiceWebhookUseCase")
+class TestLambdaHandlerProjects:
+    def test_project_from_path_parameters(
+        self, use_case_class_mock, testing_config, event_content_invoice_credited
+    ):
+        testing_config._configs_dict["STARKBANK_PROJECTS"] = "acme, iron-bank"
+        testing_config._configs_dict["IRON_BANK__TRANSFERS_TAG"] = "iron-bank"
+        use_case_class_mock.return_value.process_invoice_credited_webhook.return_value = (
+            200,
+            "Ok",
+            "Created transfer with id 123",
+        )
+        lambda_event = {
+            "path": "/webhook/iron-bank",
+            "headers": {"Digital-Signature": DIGITAL_SIGNATURE},
+            "pathParameters": {"project": "iron-bank"},
+            "body": json.dumps(event_content_invoice_credited),
+        }
+
+        response = lambda_handler(
+            event=lambda_event, context=mock.ANY, config=testing_config
+        )
+
+        assert response["statusCode"] == 200
+        project_config = use_case_class_mock.call_args.kwargs["config"]
+        assert project_config.project == "iron-bank"
+        assert project_config["TRANSFERS_TAG"] == "iron-bank"
+        assert project_config["REDIS_HOST"] == testing_config["REDIS_HOST"]
+
+    def test_project_from_headers(
+        self, use_case_class_mock, testing_config, event_content_invoice_credited
+    ):
+        testing_config._configs_dict["STARKBANK_PROJECTS"] = "acme"
+        use_case_class_mock.return_value.process_invoice_credited_webhook.return_value = (
+            200,
+            "Ok",
+            "Created transfer with id 123",
+        )
+        lambda_event = {
+            "path": "/webhook",
+            "headers": {
+                "Digital-Signature": DIGITAL_SIGNATURE,
+                "Starkbank-Project": "acme",
+            },
+            "pathParameters": None,
+            "body": json.dumps(event_content_invoice_credited),
+        }
+
+        lambda_handler(event=lambda_event, context=mock.ANY, config=testing_config)
+
+        assert use_case_class_mock.call_args.kwargs["config"].project == "acme"
+
+    def test_unknown_project(
+        self, use_case_class_mock, testing_config, event_content_invoice_credited
+    ):
+        testing_config._configs_dict["STARKBANK_PROJECTS"] = "acme"
+        lambda_event = {
+            "path": "/webhook/unknown",
+            "headers": {"Digital-Signature": DIGITAL_SIGNATURE},
+            "pathParameters": {"project": "unknown"},
+            "body": json.dumps(event_content_invoice_credited),
+        }
+
+        response = lambda_handler(
+            event=lambda_event, context=mock.ANY, config=testing_config
+        )
+
+        assert response == {
+            "statusCode": 404,
+            "body": json.dumps({"message": "Unknown project"}),
+        }
+        use_case_class_mock.assert_not_called()
+
+
+@mock.patch("src.app.InvoiceWebhookUseCase")
+class TestLambdaHandlerWarmUp:
+    def test_scheduled_warm_up(self, use_case_class_mock, testing_config):
+        testing_config._configs_dict["STARKBANK_PROJECTS"] = "acme"
+        use_case_class_mock.return_value.warm_up.return_value = {
+            "redis": 0.01,
+            "public_key": 0.2,
+        }
+        lambda_event = {
+            "source": "aws.events",
+            "detail-type": "Scheduled Event",
+            "detail": {},
+        }
+
+        response = lambda_handler(
+            event=lambda_event, context=mock.ANY, config=testing_config
+        )
+
+        assert response["statusCode"] == 200
+        body = json.loads(response["body"])
+        assert body["message"] == "Warmed up"
+        assert set(body["timings"]) == {"default", "acme"}
+        assert set(body["timings"]["acme"]) == {"adapter", "redis", "public_key"}
+        assert use_case_class_mock.call_count == 2
+        use_case_class_mock.return_value.process_invoice_credited_webhook.assert_not_called()
+
+    def test_warm_up_flag(self, use_case_class_mock, testing_config):
+        use_case_class_mock.return_value.warm_up.return_value = {}
+
+        response = lambda_handler(
+            event={"warmup": True}, context=mock.ANY, config=testing_config
+        )
+
+        assert json.loads(response["body"])["message"] == "Warmed up"
+        use_case_class_mock.return_value.warm_up.assert_called_once()
+        use_case_class_mock.return_value.process_invoice_credited_webhook.assert_not_called()
+
+
+@mock.patch("src.app.InvoiceWebhookUseCase.process_invoice_credited_webhook")
+class TestLambdaHandlerPreFilter:
+    def test_rejects_before_verification(
+        self, process_invoice_credited_webhook_mock, testing_config
+    ):
+        lambda_event = {
+            "path": "/webhook",
+            "headers": {"Digital-Signature": "Signature"},
+            "body": "{}",
+        }
+
+        response = lambda_handler(
+            event=lambda_event, context=mock.ANY, config=testing_config
+        )
+
+        assert response == {
+            "statusCode": 401,
+            "body": json.dumps({"message": "Invalid Digital-Signature"}),
+        }
+        process_invoice_credited_webhook_mock.assert_not_called()
+
+    def test_decodes_base64_encoded_body(
+        self,
+        process_invoice_credited_webhook_mock,
+        testing_config,
+        event_content_invoice_credited,
+    ):
+        import base64
+
+        event_body = json.dumps(event_content_invoice_credited)
+        process_invoice_credited_webhook_mock.return_value = (200, "Ok", "Ok")
+        lambda_event = {
+            "path": "/webhook",
+            "headers": {"Digital-Signature": DIGITAL_SIGNATURE},
+            "body": base64.b64encode(event_body.encode()).decode(),
+            "isBase64Encoded": True,
+        }
+
+        lambda_handler(event=lambda_event, context=mock.ANY, config=testing_config)
+
+        process_invoice_credited_webhook_mock.assert_called_once_with(
+            event_body=event_body, event_headers=lambda_event["headers"]
+        )
+
+
+class TestLambdaHandlerHeaders:
+    def test_null_headers(self, testing_config, event_content_invoice_credited):
+        lambda_event = {
+            "path": "/webhook",
+            "headers": None,
+            "body": json.dumps(event_content_invoice_credited),
+        }
+
+        response = lambda_handler(
+            event=lambda_event, context=mock.ANY, config=testing_config
+        )
+
+        assert response == {
+            "statusCode": 401,
+            "body": json.dumps(
+                {
+                    "message": "Digital-Signature not provided on headers, can not confirm webhook authenticity"
+                }
+            ),
+        }
+
+
+@mock.patch("src.app.InvoiceWebhookUseCase")
+class TestLambdaHandlerAudit:
+    def test_flushes_audit_at_end_of_invocation(
+        self, use_case_class_mock, testing_config, event_content_invoice_credited
+    ):
+        use_case_mock = use_case_class_mock.return_value
+        use_case_mock.process_invoice_credited_webhook.side_effect = RuntimeError
+        lambda_event = {
+            "path": "/webhook",
+            "headers": {"Digital-Signature": DIGITAL_SIGNATURE},
+            "body": json.dumps(event_content_invoice_credited),
+        }
+
+        with pytest.raises(RuntimeError):
+            lambda_handler(event=lambda_event, context=mock.ANY, config=testing_config)
+
+        use_case_mock.flush_audit.assert_called_once_with()
@@ -0,0 +1,214 @@
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import fakeredis
+import pytest
+import redis
+
+from src.audit import (
+    AuditBuffer,
+    AuditRecord,
+    JsonlAuditSink,
+    RedisStreamAuditSink,
+    audit_buffer_from_config,
+    main,
+)
+
+
+@pytest.fixture
+def redis_client():
+    client = fakeredis.FakeRedis()
+    yield client
+    client.flushall()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def audit_record(event_id, recorded_at=None):
+    return AuditRecord(
+        recorded_at=(recorded_at or datetime.now(timezone.utc)).isoformat(),
+        outcome="transferred",
+        status_code=200,
+        event_id=event_id,
+        invoice_id="5807638394699776",
+        paid_amount=10000,
+        invoice_fee=100,
+        transfer_ids=["123"],
+        timings={"total": 0.1},
+    )
+
+
+class TestAuditBuffer:
+    def test_flushes_on_batch_size(self):
+        sink = mock.Mock()
+        buffer = AuditBuffer(sink=sink, batch_size=2)
+
+        records = [audit_record("1"), audit_record("2")]
+
+        buffer.record(records[0])
+        sink.write.assert_not_called()
+        buffer.record(records[1])
+
+        sink.write.assert_called_once_with(records)
+        assert len(buffer) == 0
+
+    def test_flushes_on_interval(self):
+        sink = mock.Mock()
+        clock = FakeClock()
+        buffer = AuditBuffer(sink=sink, flush_interval=5, clock=clock)
+
+        buffer.record(audit_record("1"))
+        clock.now = 5
+        buffer.record(audit_record("2"))
+
+        assert [record.event_id for record in sink.write.call_args.args[0]] == [
+            "1",
+            "2",
+        ]
+
+    def test_keeps_failed_batches_up_to_max_pending(self):
+        sink = mock.Mock()
+        sink.write.side_effect = redis.ConnectionError
+        buffer = AuditBuffer(sink=sink, max_pending=3)
+        for event_id in "12":
+            buffer.record(audit_record(event_id))
+
+        assert buffer.flush() == 0
+        for event_id in "34":
+            buffer.record(audit_record(event_id))
+        sink.write.side_effect = None
+
+        assert buffer.flush() == 3
+        assert [record.event_id for record in sink.write.call_args.args[0]] == [
+            "2",
+            "3",
+            "4",
+        ]
+        assert buffer.dropped == 1
+
+
+class TestRedisStreamAuditSink:
+    def test_write_and_read(self, redis_client):
+        sink = RedisStreamAuditSink(redis_client=redis_client, read_batch_size=2)
+        now = datetime.now(timezone.utc)
+        records = [
+            audit_record("1", recorded_at=now - timedelta(hours=1)),
+            audit_record("2", recorded_at=now),
+            audit_record("3", recorded_at=now),
+        ]
+
+        sink.write(records)
+
+        assert list(sink.read()) == records
+        assert list(sink.read(after=now - timedelta(minutes=1))) == records[1:]
+
+    def test_read_after_naive_datetime_as_utc(self, redis_client):
+        sink = RedisStreamAuditSink(redis_client=redis_client)
+        now = datetime.now(timezone.utc)
+        records = [
+            audit_record("1", recorded_at=now - timedelta(hours=1)),
+            audit_record("2", recorded_at=now),
+        ]
+        sink.write(records)
+
+        after = (now - timedelta(minutes=1)).replace(tzinfo=None)
+
+        assert list(sink.read(after=after)) == records[1:]
+
+
+class TestJsonlAuditSink:
+    def test_write_and_read(self, tmp_path):
+        sink = JsonlAuditSink(path=str(tmp_path / "audit.jsonl"))
+        now = datetime.now(timezone.utc)
+        records = [
+            audit_record("1", recorded_at=now - timedelta(hours=1)),
+            audit_record("2", recorded_at=now),
+        ]
+
+        sink.write(records[:1])
+        sink.write(records[1:])
+
+        assert list(sink.read()) == records
+        assert list(sink.read(after=now)) == records[1:]
+
+    def test_read_after_naive_datetime_as_utc(self, tmp_path):
+        sink = JsonlAuditSink(path=str(tmp_path / "audit.jsonl"))
+        now = datetime.now(timezone.utc)
+        records = [
+            audit_record("1", recorded_at=now - timedelta(hours=1)),
+            audit_record("2", recorded_at=now),
+        ]
+        sink.write(records)
+
+        assert list(sink.read(after=now.replace(tzinfo=None))) == records[1:]
+
+
+class TestAuditBufferFromConfig:
+    def test_disabled(self, testing_config, redis_client):
+        assert audit_buffer_from_config(redis_client, testing_config) is None
+
+    def test_shared_by_process(self, testing_config, redis_client):
+        testing_config._configs_dict["AUDIT_SINK"] = "redis"
+
+        buffer = audit_buffer_from_config(redis_client, testing_config)
+
+        assert audit_buffer_from_config(redis_client, testing_config) is buffer
+
+    def test_jsonl_sink_requires_file(self, testing_config, redis_client):
+        testing_config._configs_dict["AUDIT_SINK"] = "jsonl"
+
+        with pytest.raises(ValueError):
+            audit_buffer_from_config(redis_client, testing_config)
+
+    def test_unknown_sink(self, testing_config, redis_client):
+        testing_config._configs_dict["AUDIT_SINK"] = "kafka"
+
+        with pytest.raises(ValueError):
+            audit_buffer_from_config(redis_client, testing_config)
+
+
+class TestMain:
+    def test_exports_records(self, testing_config, tmp_path):
+        audit_file = tmp_path / "audit.jsonl"
+        output_file = tmp_path / "export.jsonl"
+        testing_config._configs_dict.update(
+            {"AUDIT_SINK": "jsonl", "AUDIT_FILE": str(audit_file)}
+        )
+        JsonlAuditSink(path=str(audit_file)).write([audit_record("1")])
+
+        main(["--output", str(output_file)], config=testing_config)
+
+        exported = [json.loads(line) for line in output_file.read_text().splitlines()]
+        assert [record["event_id"] for record in exported] == ["1"]
+
+    def test_exports_records_after_naive_date(self, testing_config, tmp_path):
+        audit_file = tmp_path / "audit.jsonl"
+        output_file = tmp_path / "export.jsonl"
+        testing_config._configs_dict.update(
+            {"AUDIT_SINK": "jsonl", "AUDIT_FILE": str(audit_file)}
+        )
+        JsonlAuditSink(path=str(audit_file)).write(
+            [
+                audit_record(
+                    "1", recorded_at=datetime(2024, 1, 30, tzinfo=timezone.utc)
+                ),
+                audit_record(
+                    "2", recorded_at=datetime(2024, 1, 31, tzinfo=timezone.utc)
+                ),
+            ]
+        )
+
+        main(
+            ["--after", "2024-01-31", "--output", str(output_file)],
+            config=testing_config,
+        )
+
+        exported = [json.loads(line) for line in output_file.read_text().splitlines()]
+        assert [record["event_id"] for record in exported] == ["2"]
@@ -0,0 +1,104 @@
+from unittest import mock
+
+import fakeredis
+import pytest
+import redis
+
+from src.cache import LRUCache, ReadThroughCache, process_lru_cache
+
+
+@pytest.fixture
+def redis_client():
+    client = fakeredis.FakeRedis()
+    yield client
+    client.flushall()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+    def test_expires_entries(self):
+        clock = FakeClock()
+        cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+        cache.set("a", 1)
+
+        clock.now = 9
+        assert cache.get("a") == 1
+
+        clock.now = 10
+        assert cache.get("a", "expired") == "expired"
+        assert len(cache) == 0
+
+
+class TestProcessLRUCache:
+    def test_returns_same_cache_by_name(self):
+        cache = process_lru_cache("test-process-lru-cache", maxsize=2)
+
+        assert process_lru_cache("test-process-lru-cache", maxsize=10) is cache
+
+
+class TestReadThroughCache:
+    def test_loads_once(self):
+        cache = ReadThroughCache(local=LRUCache(maxsize=2))
+        loader = mock.Mock(return_value=10100)
+
+        assert cache.get_or_load("5807638394699776", loader) == 10100
+        assert cache.get_or_load("5807638394699776", loader) == 10100
+        loader.assert_called_once()
+
+    def test_shares_values_through_redis(self, redis_client):
+        first_cache = ReadThroughCache(
+            local=LRUCache(maxsize=2),
+            redis_client=redis_client,
+            key_prefix="p:",
+            ttl=60,
+        )
+        second_cache = ReadThroughCache(
+            local=LRUCache(maxsize=2),
+            redis_client=redis_client,
+            key_prefix="p:",
+            ttl=60,
+        )
+        first_cache.get_or_load("5807638394699776", lambda: 10100)
+        loader = mock.Mock()
+
+        assert second_cache.get_or_load("5807638394699776", loader) == 10100
+        loader.assert_not_called()
+        assert redis_client.ttl("p:5807638394699776") == 60
+
+    def test_falls_back_to_loader_on_redis_error(self):
+        redis_client = mock.Mock()
+        redis_client.get.side_effect = redis.ConnectionError
+        redis_client.set.side_effect = redis.ConnectionError
+        cache = ReadThroughCache(local=LRUCache(maxsize=2), redis_client=redis_client)
+
+        assert cache.get_or_load("5807638394699776", lambda: 10100) == 10100
+        assert cache.get("5807638394699776") == 10100
+
+    def test_undecodable_redis_value_is_a_miss(self, redis_client):
+        redis_client.set("p:5807638394699776", b"not json")
+        cache = ReadThroughCache(
+            local=LRUCache(maxsize=2), redis_client=redis_client, key_prefix="p:"
+        )
+
+        assert cache.get_or_load("5807638394699776", lambda: 10100) == 10100
+        assert redis_client.get("p:5807638394699776") == b"10100"
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import src.config
+from src.config import ProjectConfig, as_bool, get_projects
+
+
+class TestProjectConfig:
+    def test_prefers_project_keys(self):
+        config = src.config.TestingConfig(
+            {
+                "TRANSFERS_TAG": "shared",
+                "IRON_BANK__TRANSFERS_TAG": "iron-bank",
+                "REDIS_HOST": "localhost",
+            }
+        )
+
+        project_config = ProjectConfig(config=config, project="iron-bank")
+
+        assert project_config.project == "iron-bank"
+        assert project_config["TRANSFERS_TAG"] == "iron-bank"
+        assert project_config["REDIS_HOST"] == "localhost"
+        assert project_config["MISSING"] is None
+
+    def test_project_keys_do_not_fall_back(self):
+        config = src.config.TestingConfig(
+            {
+                "STARKBANK_PROJECT_ID": "shared",
+                "TRANSFER_DESTINATION_ACCOUNT": "shared",
+                "ACME__STARKBANK_PROJECT_ID": "acme",
+            }
+        )
+
+        project_config = ProjectConfig(config=config, project="acme")
+
+        assert project_config["STARKBANK_PROJECT_ID"] == "acme"
+        with pytest.raises(ValueError, match="ACME__TRANSFER_DESTINATION_ACCOUNT"):
+            project_config["TRANSFER_DESTINATION_ACCOUNT"]
+
+
+class TestStagingConfig:
+    def test_projects_secrets(self, monkeypatch):
+        monkeypatch.setenv(
+            "STARKBANK_PROJECTS_SECRETS",
+            json.dumps(
+                {
+                    "ACME__STARKBANK_PROJECT_ID": "acme",
+                    "ACME__TRANSFERS_TAG": "from-secret",
+                }
+            ),
+        )
+        monkeypatch.setenv("ACME__TRANSFERS_TAG", "from-env")
+
+        config = src.config.StagingConfig()
+
+        assert config["ACME__STARKBANK_PROJECT_ID"] == "acme"
+        assert config["ACME__TRANSFERS_TAG"] == "from-env"
+
+
+class TestGetProjects:
+    def test_get_projects(self):
+        config = src.config.TestingConfig({"STARKBANK_PROJECTS": "acme, iron-bank,"})
+
+        assert get_projects(config) == ["acme", "iron-bank"]
+
+    def test_no_projects(self):
+        assert get_projects(src.config.TestingConfig({})) == []
+
+
+class TestAsBool:
+    def test_as_bool(self):
+        assert as_bool("true") is True
+        assert as_bool("1") is True
+        assert as_bool("false") is False
+        assert as_bool(None) is False
+        assert as_bool(True) is True
@@ -0,0 +1,162 @@
+import time
+
+import fakeredis
+import pytest
+
+from src.config import TestingConfig
+from src.dedup import (
+    BucketedDedupStore,
+    KeyDedupStore,
+    dedup_store_from_config,
+)
+
+
+@pytest.fixture
+def redis_client():
+    client = fakeredis.FakeRedis()
+    yield client
+    client.flushall()
+
+
+class FakeClock:
+    def __init__(self, bucket_size):
+        self.now = float(int(time.time()) // bucket_size * bucket_size)
+
+    def __call__(self):
+        return self.now
+
+
+class TestKeyDedupStore:
+    def test_mark_as_processed(self, redis_client):
+        store = KeyDedupStore(redis_client=redis_client, expiration=60)
+
+        assert store.mark_as_processed("6046987522670592") is True
+        assert store.mark_as_processed("6046987522670592") is False
+        assert redis_client.ttl("starkbank-event-id:6046987522670592") == 60
+
+
+class TestBucketedDedupStore:
+    def test_mark_as_processed(self, redis_client):
+        clock = FakeClock(bucket_size=100)
+        store = BucketedDedupStore(
+            redis_client=redis_client,
+            expiration=600,
+            bucket_size=100,
+            shards=16,
+            clock=clock,
+        )
+
+        assert store.mark_as_processed("6046987522670592") is True
+        assert store.mark_as_processed("6046987522670592") is False
+        assert store.mark_as_processed("6046987522670593") is True
+
+        bucket = int(clock.now) // 100
+        bucket_key = f"starkbank-event-ids:{bucket}:{6046987522670592 % 16}"
+        assert redis_client.sismember(bucket_key, "6046987522670592")
+        assert 600 < redis_client.ttl(bucket_key) <= 100 + 600
+
+    def test_event_on_previous_bucket_is_duplicated(self, redis_client):
+        clock = FakeClock(bucket_size=100)
+        store = BucketedDedupStore(
+            redis_client=redis_client,
+            expiration=600,
+            bucket_size=100,
+            shards=16,
+            clock=clock,
+        )
+        store.mark_as_processed("6046987522670592")
+
+        clock.now += 599
+
+        assert store.mark_as_processed("6046987522670592") is False
+
+    def test_event_after_expiration_window_is_processed_again(self, redis_client):
+        clock = FakeClock(bucket_size=100)
+        store = BucketedDedupStore(
+            redis_client=redis_client,
+            expiration=600,
+            bucket_size=100,
+            shards=16,
+            clock=clock,
+        )
+        store.mark_as_processed("6046987522670592")
+
+        clock.now += 700
+
+        assert store.mark_as_processed("6046987522670592") is True
+
+    def test_event_on_legacy_key_is_duplicated(self, redis_client):
+        KeyDedupStore(redis_client=redis_client, expiration=600).mark_as_processed(
+            "6046987522670592"
+        )
+        store = BucketedDedupStore(
+            redis_client=redis_client,
+            expiration=600,
+            legacy_key_prefix="starkbank-event-id:",
+        )
+
+        assert store.mark_as_processed("6046987522670592") is False
+        assert store.mark_as_processed("6046987522670593") is True
+
+    def test_non_numeric_event_id(self, redis_client):
+        store = BucketedDedupStore(redis_client=redis_client, expiration=600)
+
+        assert store.mark_as_processed("event-a") is True
+        assert store.mark_as_processed("event-a") is False
+
+
+class TestDedupStoreFromConfig:
+    def test_default_storage(self, redis_client):
+        config = TestingConfig({"DUPLICATED_EVENT_VALIDATION_EXP": "60"})
+
+        store = dedup_store_from_config(redis_client=redis_client, config=config)
+
+        assert isinstance(store, KeyDedupStore)
+
+    def test_buckets_storage(self, redis_client):
+        config = TestingConfig(
+            {
+                "DUPLICATED_EVENT_VALIDATION_EXP": "60",
+                "DUPLICATED_EVENT_VALIDATION_STORAGE": "buckets",
+                "DUPLICATED_EVENT_VALIDATION_BUCKET_SIZE": "10",
+                "DUPLICATED_EVENT_VALIDATION_BUCKET_SHARDS": "4",
+            }
+        )
+
+        store = dedup_store_from_config(redis_client=redis_client, config=config)
+
+        assert isinstance(store, BucketedDedupStore)
+        assert store._legacy_key_prefix == "starkbank-event-id:"
+
+    def test_buckets_storage_without_legacy_keys(self, redis_client):
+        config = TestingConfig(
+            {
+                "DUPLICATED_EVENT_VALIDATION_STORAGE": "buckets",
+                "DUPLICATED_EVENT_VALIDATION_LEGACY_KEYS": "false",
+            }
+        )
+        redis_client.set("starkbank-event-id:6046987522670592", 1)
+
+        store = dedup_store_from_config(redis_client=redis_client, config=config)
+
+        assert store.mark_as_processed("6046987522670592") is True
+
+    def test_unknown_storage(self, redis_client):
+        config = TestingConfig(
+            {
+                "DUPLICATED_EVENT_VALIDATION_EXP": "60",
+                "DUPLICATED_EVENT_VALIDATION_STORAGE": "unknown",
+            }
+        )
+
+        with pytest.raises(ValueError):
+            dedup_store_from_config(redis_client=redis_client, config=config)
+
+    def test_default_expiration(self, redis_client):
+        config = TestingConfig({})
+
+        dedup_store_from_config(
+            redis_client=redis_client, config=config
+        ).mark_as_processed("6046987522670592")
+
+        assert redis_client.ttl("starkbank-event-id:6046987522670592") == 36000
@@ -0,0 +1,92 @@
+import base64
+import json
+
+import pytest
+
+from src import prefilter
+from src.prefilter import WebhookPreFilter
+
+DIGITAL_SIGNATURE = (
+    "MEQCIFzY+PQvIJZOKHJzWvT0ALV44+zJFuqNsdBX0u+IZLaZ"
+    "AiAjuKTCMxr3WGWGt74ZdE0jDuD8I4ZE0N5X1JnPisXu9g=="
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_rejections():
+    prefilter.rejections.clear()
+
+
+class TestWebhookPreFilter:
+    def test_valid_request(self, event_content_invoice_credited):
+        event_body = json.dumps(event_content_invoice_credited)
+
+        result = WebhookPreFilter().filter(
+            event_body=event_body, digital_signature=DIGITAL_SIGNATURE
+        )
+
+        assert result == (event_body, None)
+        assert not prefilter.rejections
+
+    def test_base64_encoded_body_decoded(self, event_content_invoice_credited):
+        event_body = json.dumps(event_content_invoice_credited)
+
+        result = WebhookPreFilter().filter(
+            event_body=base64.b64encode(event_body.encode()).decode(),
+            digital_signature=DIGITAL_SIGNATURE,
+            is_base64_encoded=True,
+        )
+
+        assert result == (event_body, None)
+
+    def test_missing_body_and_signature_left_to_use_case(self):
+        assert WebhookPreFilter().filter(event_body=None, digital_signature=None) == (
+            None,
+            None,
+        )
+
+    @pytest.mark.parametrize(
+        "event_body, is_base64_encoded, reason",
+        [
+            ("{" + "a" * 100 + "}", False, "body_too_large"),
+            (
+                base64.b64encode(b"{" + b"a" * 200 + b"}").decode(),
+                True,
+                "body_too_large",
+            ),
+            ("not base64!", True, "body_not_base64"),
+            ("<xml></xml>", False, "body_not_json"),
+            ("[1, 2]", False, "body_not_json"),
+        ],
+    )
+    def test_invalid_body(self, event_body, is_base64_encoded, reason):
+        _, rejection = WebhookPreFilter(max_body_size=100).filter(
+            event_body=event_body,
+            digital_signature=DIGITAL_SIGNATURE,
+            is_base64_encoded=is_base64_encoded,
+        )
+
+        assert rejection.reason == reason
+        assert rejection.status_code == 400
+        assert rejection.response_message == "Invalid body"
+        assert prefilter.rejections == {reason: 1}
+
+    @pytest.mark.parametrize(
+        "digital_signature, reason",
+        [
+            ("Signature", "signature_length"),
+            ("A" * 300, "signature_length"),
+            ("M" * 95, "signature_malformed"),
+            ("M" * 92 + "!@#$", "signature_malformed"),
+        ],
+    )
+    def test_invalid_signature(self, digital_signature, reason):
+        event_body, rejection = WebhookPreFilter().filter(
+            event_body="{}", digital_signature=digital_signature
+        )
+
+        assert event_body == "{}"
+        assert rejection.reason == reason
+        assert rejection.status_code == 401
+        assert rejection.response_message == "Invalid Digital-Signature"
+        assert prefilter.rejections == {reason: 1}
@@ -0,0 +1,199 @@
+import io
+import json
+import logging
+from datetime import date, timedelta, timezone
+from unittest import mock
+
+import pytest
+from starkcore.utils.checks import check_datetime
+
+from src.reconciliation import InvoiceReconciliationUseCase
+
+
+def credited_log(log_id, invoice_id, created):
+    return mock.Mock(
+        id=log_id,
+        created=created,
+        invoice=mock.Mock(id=invoice_id, fee=100, tags=[], tax_id="012.345.678-90"),
+    )
+
+
+def transfer(transfer_id, created, tags, account_number="1234567-8"):
+    return mock.Mock(
+        id=transfer_id,
+        created=created,
+        tags=tags,
+        tax_id="123.456.789-00",
+        bank_code="123",
+        branch_code="12345-7",
+        account_number=account_number,
+    )
+
+
+@pytest.fixture
+def day():
+    return check_datetime("2024-01-31T00:00:00.000000+00:00")
+
+
+@pytest.fixture
+def webhook_use_case(day):
+    webhook_use_case = mock.Mock()
+    webhook_use_case.sb_adapter.get_credited_invoice_logs.return_value = iter(
+        [
+            credited_log("l4", "i4", day + timedelta(hours=20)),
+            credited_log("l3", "i3", day + timedelta(hours=15)),
+            credited_log("l2", "i2", day + timedelta(hours=10)),
+            credited_log("l1", "i1", day + timedelta(hours=5)),
+        ]
+    )
+    webhook_use_case.sb_adapter.get_transfers.return_value = iter(
+        [
+            transfer("t5", day + timedelta(hours=22), ["test", "invoice-i9"]),
+            transfer("t6", day + timedelta(hours=21), ["test"]),
+            transfer(
+                "t4", day + timedelta(hours=20, seconds=2), ["test", "invoice-i4"]
+            ),
+            transfer(
+                "t2b", day + timedelta(hours=10, seconds=9), ["test", "invoice-i2"]
+            ),
+            transfer(
+                "t2", day + timedelta(hours=10, seconds=3), ["test", "invoice-i2"]
+            ),
+            transfer("t1", day + timedelta(hours=5, seconds=1), ["test", "invoice-i1"]),
+            transfer(
+                "t1b",
+                day + timedelta(hours=5, seconds=1),
+                ["test", "invoice-i1"],
+                account_number="7654321-0",
+            ),
+        ]
+    )
+    webhook_use_case.reprocess_credited_invoice.return_value = ["t3"]
+    return webhook_use_case
+
+
+class TestInvoiceReconciliationUseCase:
+    logger = logging.getLogger()
+
+    def test_reconcile(self, testing_config, webhook_use_case, day):
+        use_case = InvoiceReconciliationUseCase(
+            logger=self.logger,
+            config=testing_config,
+            webhook_use_case=webhook_use_case,
+        )
+        output = io.StringIO()
+
+        report = use_case.reconcile(
+            after=date(2024, 1, 31), before=date(2024, 1, 31), output=output
+        )
+
+        mismatches = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [mismatch["type"] for mismatch in mismatches] == [
+            "transfer_without_credited_invoice",
+            "transfer_without_credited_invoice",
+            "missing_transfer",
+            "multiple_transfers",
+        ]
+        assert mismatches[0]["transfer_id"] == "t6"
+        assert mismatches[0]["invoice_id"] is None
+        assert mismatches[1]["transfer_id"] == "t5"
+        assert mismatches[1]["invoice_id"] == "i9"
+        assert mismatches[2]["invoice_id"] == "i3"
+        assert mismatches[2]["reprocessed_transfer_ids"] is None
+        assert mismatches[3]["transfer_ids"] == ["t2b", "t2"]
+        assert report.credited_invoices == 4
+        assert report.transfers == 7
+        assert report.mismatches == 4
+        assert report.reprocessed == 0
+        webhook_use_case.reprocess_credited_invoice.assert_not_called()
+        webhook_use_case.sb_adapter.get_transfers.assert_called_once_with(
+            after=date(2024, 1, 31), before=date(2024, 2, 1), tag="test"
+        )
+
+    def test_reconcile_reprocessing_missing_transfers(
+        self, testing_config, webhook_use_case
+    ):
+        use_case = InvoiceReconciliationUseCase(
+            logger=self.logger,
+            config=testing_config,
+            webhook_use_case=webhook_use_case,
+        )
+        output = io.StringIO()
+
+        report = use_case.reconcile(
+            after=date(2024, 1, 31),
+            before=date(2024, 1, 31),
+            output=output,
+            reprocess=True,
+            reprocess_after=date(2024, 1, 31),
+        )
+
+        missing_transfer = json.loads(output.getvalue().splitlines()[2])
+        assert missing_transfer["reprocessed_transfer_ids"] == ["t3"]
+        assert report.reprocessed == 1
+        webhook_use_case.reprocess_credited_invoice.assert_called_once_with(
+            invoice_id="i3",
+            invoice_fee=100,
+            invoice_tags=[],
+            invoice_tax_id="012.345.678-90",
+        )
+
+    def test_reconcile_not_reprocessing_before_cutoff(
+        self, testing_config, webhook_use_case
+    ):
+        use_case = InvoiceReconciliationUseCase(
+            logger=self.logger,
+            config=testing_config,
+            webhook_use_case=webhook_use_case,
+        )
+
+        report = use_case.reconcile(
+            after=date(2024, 1, 31),
+            before=date(2024, 1, 31),
+            output=io.StringIO(),
+            reprocess=True,
+            reprocess_after=date(2024, 2, 1),
+        )
+
+        assert report.reprocessed == 0
+        webhook_use_case.reprocess_credited_invoice.assert_not_called()
+
+    def test_reconcile_not_reprocessing_recent_invoices(
+        self, testing_config, webhook_use_case, day
+    ):
+        use_case = InvoiceReconciliationUseCase(
+            logger=self.logger,
+            config=testing_config,
+            webhook_use_case=webhook_use_case,
+            clock=lambda: (
+                day.replace(tzinfo=timezone.utc) + timedelta(hours=15, minutes=30)
+            ).timestamp(),
+        )
+
+        report = use_case.reconcile(
+            after=date(2024, 1, 31),
+            before=date(2024, 1, 31),
+            output=io.StringIO(),
+            reprocess=True,
+            reprocess_after=date(2024, 1, 31),
+        )
+
+        assert report.reprocessed == 0
+        webhook_use_case.reprocess_credited_invoice.assert_not_called()
+
+    def test_reconcile_reprocessing_requires_cutoff(
+        self, testing_config, webhook_use_case
+    ):
+        use_case = InvoiceReconciliationUseCase(
+            logger=self.logger,
+            config=testing_config,
+            webhook_use_case=webhook_use_case,
+        )
+
+        with pytest.raises(ValueError):
+            use_case.reconcile(
+                after=date(2024, 1, 31),
+                before=date(2024, 1, 31),
+                output=io.StringIO(),
+                reprocess=True,
+            )
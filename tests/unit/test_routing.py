@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+from src.clients.starkbank import InvoiceLog, TransferDestination
+from src.routing import RoutingRule, TransferRouter, transfer_router_from_config
+
+DEFAULT_DESTINATION = TransferDestination(
+    name="Fulano da Silva",
+    cpf_cnpj="123.456.789-00",
+    bank_code="123",
+    branch_code="12345-7",
+    account_number="1234567-8",
+    account_type="checking",
+)
+
+
+def destination(account_number, weight=1):
+    return {
+        "name": "Ciclano de Souza",
+        "cpf_cnpj": "987.654.321-00",
+        "bank_code": "456",
+        "branch_code": "0001",
+        "account_number": account_number,
+        "weight": weight,
+    }
+
+
+def router(*rules):
+    return TransferRouter(
+        rules=[RoutingRule.from_dict(rule) for rule in rules],
+        default_destination=DEFAULT_DESTINATION,
+    )
+
+
+def invoice_log(tags=None, tax_id=None):
+    return InvoiceLog(
+        log_type="credited",
+        invoice_fee=100,
+        invoice_id="5807638394699776",
+        paid_amount=10100,
+        invoice_tags=tags,
+        invoice_tax_id=tax_id,
+    )
+
+
+def routed_accounts(transfer_router, amount, tags=None, tax_id=None):
+    return [
+        (route.destination.account_number, route.amount)
+        for route in transfer_router.route(
+            invoice_log=invoice_log(tags=tags, tax_id=tax_id), amount=amount
+        )
+    ]
+
+
+class TestTransferRouter:
+    def test_falls_back_to_default_destination(self):
+        transfer_router = router({"tags": ["acme"], "destinations": [destination("1")]})
+
+        assert routed_accounts(transfer_router, 10000, tags=["other"]) == [
+            ("1234567-8", 10000)
+        ]
+
+    def test_routes_by_tag_tax_id_and_amount_band(self):
+        transfer_router = router(
+            {"tags": ["acme"], "destinations": [destination("tag")]},
+            {"tax_id": "20018183000180", "destinations": [destination("tax-id")]},
+            {"max_amount": 1000, "destinations": [destination("small")]},
+            {"min_amount": 1000, "destinations": [destination("large")]},
+        )
+
+        assert routed_accounts(transfer_router, 5, tags=["ACME "]) == [("tag", 5)]
+        assert routed_accounts(transfer_router, 5, tax_id="20.018.183/0001-80") == [
+            ("tax-id", 5)
+        ]
+        assert routed_accounts(transfer_router, 999) == [("small", 999)]
+        assert routed_accounts(transfer_router, 1000) == [("large", 1000)]
+
+    def test_first_matching_rule_wins(self):
+        transfer_router = router(
+            {"min_amount": 0, "max_amount": 500, "destinations": [destination("0")]},
+            {"tags": ["acme"], "min_amount": 100, "destinations": [destination("1")]},
+            {"min_amount": 200, "max_amount": 900, "destinations": [destination("2")]},
+            {"destinations": [destination("3")]},
+        )
+
+        assert routed_accounts(transfer_router, 50, tags=["acme"]) == [("0", 50)]
+        assert routed_accounts(transfer_router, 600, tags=["acme"]) == [("1", 600)]
+        assert routed_accounts(transfer_router, 600) == [("2", 600)]
+        assert routed_accounts(transfer_router, 50, tags=["other"]) == [("0", 50)]
+        assert routed_accounts(transfer_router, 900) == [("3", 900)]
+
+    def test_splits_amount_by_weight(self):
+        transfer_router = router(
+            {
+                "tags": ["acme"],
+                "destinations": [
+                    destination("1", weight=1),
+                    destination("2", weight=1),
+                    destination("3", weight=1),
+                ],
+            }
+        )
+
+        assert routed_accounts(transfer_router, 10000, tags=["acme"]) == [
+            ("1", 3333),
+            ("2", 3333),
+            ("3", 3334),
+        ]
+        assert routed_accounts(transfer_router, 2, tags=["acme"]) == [("3", 2)]
+
+    def test_rule_without_destinations(self):
+        with pytest.raises(ValueError):
+            RoutingRule.from_dict({"tags": ["acme"], "destinations": []})
+
+
+class TestTransferRouterFromConfig:
+    def test_compiled_once_per_rules(self, testing_config):
+        testing_config._configs_dict["TRANSFER_ROUTING_RULES"] = json.dumps(
+            [{"tags": ["acme"], "destinations": [destination("1")]}]
+        )
+
+        transfer_router = transfer_router_from_config(testing_config)
+
+        assert transfer_router_from_config(testing_config) is transfer_router
+        assert len(transfer_router) == 1
+        assert routed_accounts(transfer_router, 10000) == [("1234567-8", 10000)]
+
+    def test_rules_file(self, testing_config, tmp_path):
+        rules_file = tmp_path / "routing_rules.json"
+        rules_file.write_text(
+            json.dumps(
+                [{"tax_id": "20018183000180", "destinations": [destination("1")]}]
+            )
+        )
+        testing_config._configs_dict["TRANSFER_ROUTING_RULES_FILE"] = str(rules_file)
+
+        transfer_router = transfer_router_from_config(testing_config)
+
+        assert routed_accounts(transfer_router, 10000, tax_id="20.018.183/0001-80") == [
+            ("1", 10000)
+        ]
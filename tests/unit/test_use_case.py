@@ -4,53 +4,85 @@ from unittest import mock
 
 import pytest
 
+from src import use_case as use_case_module
 from src.use_case import InvoiceWebhookUseCase
 
 
 @pytest.fixture
-def mocked_adapter_class(event_entity_from_content):
+def mocked_adapter_class():
     import json
 
-    from clients.starkbank import InvalidDigitalSignature, InvoiceLog, StarkBankAdapter
+    from clients.starkbank import (
+        DuplicatedTransfer,
+        InvalidDigitalSignature,
+        InvoiceLog,
+        StarkBankAdapter,
+        WebhookEvent,
+    )
 
     class FakeStarkBankAdapter(StarkBankAdapter):
-        def __init__(self, config):
-            pass
+        def __init__(self, config, **kwargs):
+            self.created_transfer_ids = {}
 
-        def get_event_entity_and_id_from_body(
-            self, event_body: str, digital_signature: str
-        ):
+        def get_webhook_event_from_body(self, event_body: str, digital_signature: str):
             if digital_signature == "InvalidSignature":
                 raise InvalidDigitalSignature
 
-            event = event_entity_from_content(json.loads(event_body))
-            return event, event.id
+            return WebhookEvent.from_content(event_body)
 
-        def get_invoice_data_from_event_entity(self, event_entity):
-            if event_entity.subscription != "invoice":
+        def get_invoice_data_from_webhook_event(self, webhook_event):
+            if webhook_event.subscription != "invoice":
                 return None
 
-            if (log := event_entity.log).type != "credited":
-                return InvoiceLog(
-                    log_type=log.type,
-                    invoice_fee=log.invoice.fee,
-                    invoice_id=log.invoice.id,
-                    paid_amount=None,
-                )
+            invoice_log = InvoiceLog(
+                log_type=webhook_event.log_type,
+                invoice_fee=webhook_event.invoice_fee,
+                invoice_id=webhook_event.invoice_id,
+                invoice_tags=webhook_event.invoice_tags,
+                invoice_tax_id=webhook_event.invoice_tax_id,
+            )
+            if webhook_event.log_type != "credited":
+                return invoice_log
 
+            invoice = json.loads(webhook_event.content)["event"]["log"]["invoice"]
+            return invoice_log._replace(paid_amount=invoice["amount"])
+
+        def get_invoice_log(self, log_type, invoice_fee, invoice_id, **kwargs):
             return InvoiceLog(
-                log_type=log.type,
-                invoice_fee=log.invoice.fee,
-                invoice_id=log.invoice.id,
-                paid_amount=log.invoice.amount,
+                log_type=log_type,
+                invoice_fee=invoice_fee,
+                invoice_id=invoice_id,
+                paid_amount=10000,
+                **kwargs,
             )
 
-        def create_transfer(self, *args, **kwargs):
-            return "123"
+        def create_transfers(self, routes, invoice_id=None, attempt=0, **kwargs):
+            # Stark Bank rejects transfers repeating the external ids
+            if (invoice_id, attempt) in self.created_transfer_ids:
+                raise DuplicatedTransfer(
+                    self.created_transfer_ids[(invoice_id, attempt)]
+                )
+
+            transfer_ids = [str(123 + index) for index in range(len(routes))]
+            if invoice_id:
+                self.created_transfer_ids[(invoice_id, attempt)] = transfer_ids
+            return transfer_ids
+
+        def get_invoice_transfers(self, invoice_id):
+            return iter([])
 
     return mock.Mock(wraps=FakeStarkBankAdapter)
 
 
+@pytest.fixture
+def acme_config(testing_config):
+    from src.config import ProjectConfig
+
+    for key in ProjectConfig.project_keys:
+        testing_config._configs_dict[f"ACME__{key}"] = testing_config[key]
+    return ProjectConfig(config=testing_config, project="acme")
+
+
 @pytest.fixture(scope="function")
 def fake_redis_class(testing_config):
     import fakeredis
@@ -68,6 +100,46 @@ def fake_redis_class(testing_config):
 class TestInvoiceWebhookUseCase:
     logger = logging.getLogger()
 
+    def test_adapters_cached_by_project(
+        self, testing_config, acme_config, mocked_adapter_class, fake_redis_class
+    ):
+        project_config = acme_config
+        use_cases = [
+            InvoiceWebhookUseCase(
+                logger=self.logger,
+                config=config,
+                adapter_class=mocked_adapter_class,
+                redis_client_class=fake_redis_class,
+            )
+            for config in (testing_config, testing_config, project_config)
+        ]
+
+        assert use_cases[0]._sb_adapter is use_cases[1]._sb_adapter
+        assert use_cases[0]._sb_adapter is not use_cases[2]._sb_adapter
+        assert mocked_adapter_class.call_count == 2
+        assert mocked_adapter_class.call_args.kwargs["config"] is project_config
+
+    def test_adapter_caches_namespaced_by_environment_and_project(
+        self, testing_config, acme_config, mocked_adapter_class, fake_redis_class
+    ):
+        for config in (testing_config, acme_config):
+            InvoiceWebhookUseCase(
+                logger=self.logger,
+                config=config,
+                adapter_class=mocked_adapter_class,
+                redis_client_class=fake_redis_class,
+            )
+
+        default_caches, acme_caches = [
+            call.kwargs for call in mocked_adapter_class.call_args_list
+        ]
+        for cache_name in ("payment_amount_cache", "verified_event_cache"):
+            assert default_caches[cache_name]._key_prefix.endswith(":sandbox::")
+            assert acme_caches[cache_name]._key_prefix.endswith(":sandbox:acme:")
+            assert (
+                default_caches[cache_name]._local is not acme_caches[cache_name]._local
+            )
+
     def test_process_invoice_credited_webhook_sending_transfer(
         self,
         testing_config,
@@ -251,3 +323,410 @@ class TestInvoiceWebhookUseCase:
         assert status_code == 400
         assert response_message == "Request must contain body"
         assert log_message == "Received a request without body"
+
+    def test_reprocess_credited_invoice_only_once(
+        self, testing_config, mocked_adapter_class, fake_redis_class
+    ):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        first_transfer_ids = use_case.reprocess_credited_invoice(
+            invoice_id="5807638394699776", invoice_fee=100
+        )
+        second_transfer_ids = use_case.reprocess_credited_invoice(
+            invoice_id="5807638394699776", invoice_fee=100
+        )
+
+        assert first_transfer_ids == ["123"]
+        assert second_transfer_ids is None
+
+    def test_reprocess_credited_invoice_with_existing_transfer(
+        self, testing_config, mocked_adapter_class, fake_redis_class
+    ):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch.object(
+            use_case.sb_adapter,
+            "get_invoice_transfers",
+            return_value=iter(
+                [
+                    mock.Mock(id="122", status="failed"),
+                    mock.Mock(id="123", status="success"),
+                ]
+            ),
+        ), mock.patch.object(use_case.sb_adapter, "create_transfers") as create_mock:
+            transfer_ids = use_case.reprocess_credited_invoice(
+                invoice_id="5807638394699776", invoice_fee=100
+            )
+
+        assert transfer_ids is None
+        create_mock.assert_not_called()
+        assert use_case._redis_client.exists(
+            "starkbank-reprocessed-invoice:5807638394699776"
+        )
+
+    def test_process_invoice_credited_webhook_after_reprocessing(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+        reprocessed_transfer_ids = use_case.reprocess_credited_invoice(
+            invoice_id="5807638394699776", invoice_fee=100
+        )
+
+        status_code, response_message, log_message = (
+            use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_credited),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+        )
+
+        assert reprocessed_transfer_ids == ["123"]
+        assert status_code == 200
+        assert response_message == "Ok"
+        assert (
+            log_message
+            == "Invoice with id 5807638394699776 already has transfers with ids 123"
+        )
+        assert use_case.sb_adapter.created_transfer_ids == {
+            ("5807638394699776", 0): ["123"]
+        }
+
+    def test_reprocess_credited_invoice_after_webhook(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+        use_case.process_invoice_credited_webhook(
+            event_body=json.dumps(event_content_invoice_credited),
+            event_headers={"Digital-Signature": "Signature"},
+        )
+
+        transfer_ids = use_case.reprocess_credited_invoice(
+            invoice_id="5807638394699776", invoice_fee=100
+        )
+
+        assert transfer_ids is None
+        assert len(use_case.sb_adapter.created_transfer_ids) == 1
+
+    def test_reprocess_credited_invoice_with_failed_transfers(
+        self, testing_config, mocked_adapter_class, fake_redis_class
+    ):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+        use_case.sb_adapter.created_transfer_ids[("5807638394699776", 0)] = ["122"]
+
+        with mock.patch.object(
+            use_case.sb_adapter,
+            "get_invoice_transfers",
+            return_value=iter([mock.Mock(id="122", status="failed")]),
+        ):
+            transfer_ids = use_case.reprocess_credited_invoice(
+                invoice_id="5807638394699776", invoice_fee=100
+            )
+
+        assert transfer_ids == ["123"]
+        assert ("5807638394699776", 1) in use_case.sb_adapter.created_transfer_ids
+
+    def test_process_invoice_credited_webhook_with_speculative_payment_lookup(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        testing_config._configs_dict["SPECULATIVE_PAYMENT_LOOKUP"] = "true"
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch(
+            "src.use_case._get_payment_lookup_executor",
+            wraps=use_case_module._get_payment_lookup_executor,
+        ) as get_executor_mock:
+            status_code, response_message, log_message = (
+                use_case.process_invoice_credited_webhook(
+                    event_body=json.dumps(event_content_invoice_credited),
+                    event_headers={"Digital-Signature": "Signature"},
+                )
+            )
+
+        assert status_code == 200
+        assert response_message == "Ok"
+        assert log_message == "Created transfer with id 123"
+        get_executor_mock.assert_called_once_with(max_workers=4)
+
+    def test_speculative_payment_lookup_discarded_for_duplicated_event(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        testing_config._configs_dict["SPECULATIVE_PAYMENT_LOOKUP"] = "true"
+        event_id = event_content_invoice_credited["event"]["id"]
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+        use_case._redis_client.set(f"starkbank-event-id:{event_id}", 1)
+
+        with mock.patch(
+            "src.use_case._get_payment_lookup_executor"
+        ) as get_executor_mock:
+            status_code, _, log_message = use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_credited),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+
+        invoice_log_lookup = get_executor_mock.return_value.submit.return_value
+        assert status_code == 200
+        assert log_message == (
+            f"Event with id {event_id} was already" " processed before, will be ignored"
+        )
+        invoice_log_lookup.cancel.assert_called_once()
+        invoice_log_lookup.result.assert_not_called()
+
+    def test_no_speculative_payment_lookup_for_other_log_types(
+        self,
+        testing_config,
+        event_content_invoice_created,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        testing_config._configs_dict["SPECULATIVE_PAYMENT_LOOKUP"] = "true"
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch(
+            "src.use_case._get_payment_lookup_executor"
+        ) as get_executor_mock:
+            status_code, _, _ = use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_created),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+
+        assert status_code == 200
+        get_executor_mock.assert_not_called()
+
+    def test_warm_up(self, testing_config, mocked_adapter_class, fake_redis_class):
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch.object(
+            use_case.sb_adapter, "fetch_public_key"
+        ) as fetch_public_key_mock:
+            timings = use_case.warm_up()
+
+        assert set(timings) == {"redis", "public_key"}
+        fetch_public_key_mock.assert_called_once()
+        assert use_case._redis_client.keys() == []
+
+    def test_redis_clients_shared_between_invocations(
+        self, testing_config, mocked_adapter_class, fake_redis_class
+    ):
+        use_cases = [
+            InvoiceWebhookUseCase(
+                logger=self.logger,
+                config=testing_config,
+                adapter_class=mocked_adapter_class,
+                redis_client_class=fake_redis_class,
+            )
+            for _ in range(2)
+        ]
+
+        assert use_cases[0]._redis_client is use_cases[1]._redis_client
+
+    def test_process_invoice_credited_webhook_splitting_transfer_by_routing_rule(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        destination = {
+            "name": "Ciclano de Souza",
+            "cpf_cnpj": "987.654.321-00",
+            "bank_code": "456",
+            "branch_code": "0001",
+            "account_number": "7654321-0",
+        }
+        testing_config._configs_dict["TRANSFER_ROUTING_RULES"] = json.dumps(
+            [
+                {
+                    "tags": ["War Supply"],
+                    "destinations": [
+                        {**destination, "weight": 1},
+                        {**destination, "account_number": "1111111-1", "weight": 2},
+                    ],
+                }
+            ]
+        )
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch.object(
+            use_case.sb_adapter, "create_transfers", return_value=["123", "124"]
+        ) as create_transfers_mock:
+            status_code, _, log_message = use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_credited),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+
+        assert status_code == 200
+        assert log_message == "Created transfers with ids 123, 124"
+        routes = create_transfers_mock.call_args.kwargs["routes"]
+        assert [route.amount for route in routes] == [3300, 6600]
+        assert [route.destination.account_number for route in routes] == [
+            "7654321-0",
+            "1111111-1",
+        ]
+
+    def test_process_invoice_credited_webhook_audited(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        from src.audit import RedisStreamAuditSink
+
+        testing_config._configs_dict["AUDIT_SINK"] = "redis"
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        for _ in range(2):
+            use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_credited),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+        assert use_case._redis_client.xlen("starkbank-audit") == 0
+
+        assert use_case.flush_audit() == 2
+        transferred, duplicated = RedisStreamAuditSink(
+            redis_client=use_case._redis_client
+        ).read()
+        assert transferred.outcome == "transferred"
+        assert transferred.event_id == "6046987522670592"
+        assert transferred.invoice_id == "5807638394699776"
+        assert transferred.paid_amount == 10000
+        assert transferred.invoice_fee == 100
+        assert transferred.transfer_ids == ["123"]
+        assert set(transferred.timings) == {
+            "signature",
+            "dedup",
+            "invoice",
+            "transfer",
+            "total",
+        }
+        assert duplicated.outcome == "duplicated"
+        assert duplicated.invoice_id is None
+
+    def test_process_invoice_credited_webhook_fee_not_covered(
+        self,
+        testing_config,
+        event_content_invoice_credited,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        event_content_invoice_credited["event"]["log"]["invoice"]["amount"] = 100
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+
+        with mock.patch.object(
+            use_case.sb_adapter, "create_transfers"
+        ) as create_transfers_mock:
+            status_code, _, log_message = use_case.process_invoice_credited_webhook(
+                event_body=json.dumps(event_content_invoice_credited),
+                event_headers={"Digital-Signature": "Signature"},
+            )
+
+        assert status_code == 200
+        assert log_message == (
+            "Invoice with id 5807638394699776 paid amount does not cover its fee, "
+            "no transfer created"
+        )
+        create_transfers_mock.assert_not_called()
+
+    def test_flush_audit_keeps_records_the_sink_failed_to_write(
+        self,
+        testing_config,
+        event_content_invoice_created,
+        mocked_adapter_class,
+        fake_redis_class,
+    ):
+        import redis
+
+        testing_config._configs_dict["AUDIT_SINK"] = "redis"
+        use_case = InvoiceWebhookUseCase(
+            logger=self.logger,
+            config=testing_config,
+            adapter_class=mocked_adapter_class,
+            redis_client_class=fake_redis_class,
+        )
+        use_case.process_invoice_credited_webhook(
+            event_body=json.dumps(event_content_invoice_created),
+            event_headers={"Digital-Signature": "Signature"},
+        )
+
+        with mock.patch.object(
+            use_case._audit_buffer._sink, "write", side_effect=redis.ConnectionError
+        ):
+            assert use_case.flush_audit() == 0
+
+        assert use_case.flush_audit() == 1
+        assert use_case._redis_client.xlen("starkbank-audit") == 1